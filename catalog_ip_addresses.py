@@ -3,12 +3,18 @@ Logs into a list of routers and gets the ARP entries. Checks Netbox to see if th
 exists and adds them if necessary. Also makes sure the address's description field is set to
 the MAC address from the ARP table.
 """
-import re
+import bisect
 import ipaddress
-import requests
 import yaml
 import pynetbox
+import netbox_session
 from netmiko import ConnectHandler
+from device_output_parser import parse_arp_table
+from device_scraper import (DEVICE_SCHEMA, DEVICE_TIMEOUT, MAX_WORKERS, connect_to_device,
+                            scrape_devices)
+from netbox_bulk import bulk_create, bulk_update
+from slack_notifier import send_to_slack
+from yaml_loader import SUBNETS_SCHEMA, load_yaml
 
 ENV_FILE = "env.yml"
 DEVICES_FILE = "devices_to_update.yml"
@@ -28,13 +34,13 @@ def load_env_vars() -> dict:
 
 def load_devices() -> dict:
     """
-    Loads the device variables into a dictionary
+    Loads the device variables into a dictionary, making sure each device has what's needed to
+    log into it
 
     Returns:
         dict: The device variable
     """
-    with open(DEVICES_FILE, encoding="UTF-8") as file:
-        return yaml.safe_load(file)
+    return load_yaml(DEVICES_FILE, DEVICE_SCHEMA)
 
 
 def load_device_creds() -> dict:
@@ -55,76 +61,151 @@ def load_subnet_info() -> dict:
     Returns:
         dict: The subnet info
     """
-    with open(SUBNETS_FILE, encoding="UTF-8") as file:
-        return yaml.safe_load(file)
+    return load_yaml(SUBNETS_FILE, SUBNETS_SCHEMA)
 
 
-def connect_to_device(address: str, username: str, password: str,
-                      device_type:str="mikrotik_routeros") -> ConnectHandler:
+class SubnetIndex:
+    """
+    The host ranges of the subnets we care about, merged and sorted so an address can be checked
+    with a binary search instead of walking through every subnet's hosts
     """
-    Connect to the device via Netmiko using the info provided
+    def __init__(self, subnets_info: list):
+        ranges = []
+        for subnet in subnets_info:
+            network = ipaddress.IPv4Network(subnet['subnet'])
+            first = int(network.network_address)
+            last = int(network.broadcast_address)
+            # hosts() leaves out the network and broadcast addresses except on /31s and /32s
+            if network.prefixlen < 31:
+                first, last = first + 1, last - 1
+            ranges.append((first, last))
+        ranges.sort()
 
-    Args:
-        address (str): The address of the device
-        username (str): The username
-        password (str): The password
-        device_type (str, optional): The Netmiko device type to use.
-          Defaults to "mikrotik_routeros".
+        self._starts = []
+        self._ends = []
+        for first, last in ranges:
+            # Fold overlapping or back-to-back ranges together
+            if self._ends and first <= self._ends[-1] + 1:
+                self._ends[-1] = max(self._ends[-1], last)
+            else:
+                self._starts.append(first)
+                self._ends.append(last)
 
-    Returns:
-        ConnectHandler: The Netmiko ConnectionHandler object to use to run commands
-    """
-    dev_conn = {
-        'device_type': device_type,
-        'host': address,
-        'username': username,
-        'password': password,
-    }
-    return ConnectHandler(**dev_conn)
+    def __contains__(self, address) -> bool:
+        """
+        See if an address is a host in any of the subnets
+
+        Args:
+            address (str | int | ipaddress.IPv4Address): The address to check
+
+        Returns:
+            bool: Whether the address is in one of the subnets
+        """
+        address = int(ipaddress.IPv4Address(address))
+        spot = bisect.bisect_right(self._starts, address) - 1
+        return spot >= 0 and address <= self._ends[spot]
 
 
-def mikrotik_get_arp_entries(connection: ConnectHandler, subnets_info: dict) -> dict:
+def mikrotik_get_arp_entries(connection: ConnectHandler, subnets_info) -> list:
     """
     Get the ARP entries from a Mikrotik device
 
     Args:
         connection (ConnectHandler): The Netmiko ConnectionHandler object to use
-        subnets_info (dict): The subnets to check against the device
+        subnets_info (list | SubnetIndex): The subnets to check against the device. Pass a
+          SubnetIndex when checking more than one device so it only gets built once.
 
     Returns:
-        dict: A dict of the ARP entries with keys 'ip' and 'mac'
+        list: The ArpEntry (with `ip` and `mac`) for each address in the subnets
     """
-    matched_arps = []
+    if not isinstance(subnets_info, SubnetIndex):
+        subnets_info = SubnetIndex(subnets_info)
     arp_table = connection.send_command("/ip/arp/print without-paging proplist=address,mac-address")
-    arp_lines = arp_table.split("\n")
-    search_string = r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+"\
-        r"(\w{2}\:\w{2}\:\w{2}\:\w{2}\:\w{2}\:\w{2})"
-    for arp_line in arp_lines:
-        match = re.search(search_string, arp_line)
-        if match:
-            for subnet in subnets_info:
-                target_host = ipaddress.IPv4Address(match.group(1))
-                if target_host in ipaddress.IPv4Network(subnet['subnet']).hosts():
-                    matched_arps.append({'ip': match.group(1), 'mac': match.group(2)})
-                    continue
-    return matched_arps
-
-def send_to_slack(message: str, slack_url: str):
-    """
-    Send a message to Slack
+    return parse_arp_table(arp_table, subnets_info)
+
+def collect_arp_tables(devices: list, device_creds: dict, subnets_info: dict,
+                       max_workers: int = MAX_WORKERS, timeout: int = DEVICE_TIMEOUT,
+                       connect=connect_to_device) -> dict:
+    """
+    Get the ARP entries from a bunch of devices at the same time
 
     Args:
-        message (str): The message text
-        slack_url (str): The URL to post to
+        devices (list): The devices from `DEVICES_FILE`
+        device_creds (dict): The username and password for the devices
+        subnets_info (dict): The subnets to check against the devices
+        max_workers (int, optional): How many devices to work on at once. Defaults to MAX_WORKERS.
+        timeout (int, optional): Seconds to wait on each device. Defaults to DEVICE_TIMEOUT.
+        connect (callable, optional): The function used to connect to each device.
+          Defaults to connect_to_device.
 
     Returns:
-        bool: Whether or not the message was sent successfully
+        dict: The matched ARP entries keyed by device name. Devices that couldn't be reached
+          are left out.
+    """
+    # Build the subnet index once for all the devices
+    subnet_index = SubnetIndex(subnets_info)
+
+    def scrape(connection, _device):
+        # Ping everything in the subnets
+        # for subnet in subnets_info:
+        #     nodes = list(ipaddress.ip_network(subnet['subnet']).hosts())
+        #     for node in nodes:
+        #         output = connection.send_command(f"ping count=1 {format(node)}")
+
+        # Get the ARP table
+        return mikrotik_get_arp_entries(connection, subnet_index)
+
+    arp_tables, errors = scrape_devices(devices, device_creds, scrape, max_workers=max_workers,
+                                        timeout=timeout, connect=connect)
+    for device_name, err in errors.items():
+        print(f"Couldn't get the ARP table from {device_name}: {err}")
+    return arp_tables
+
+def reconcile_addresses(nb_conn: pynetbox.api, matched_arps: list, subnets_info: list) -> dict:
     """
-    headers = {"text": message}
-    post_result = requests.post(url=slack_url, json=headers, timeout=10)
-    if post_result.status_code == 200:
-        return True
-    return False
+    Make the addresses in Netbox match the ARP entries
+
+    All the addresses Netbox already has in the subnets are pulled in one paginated sweep and
+    compared to the ARP entries in memory. Only the differences go back to Netbox, as bulk PATCHes
+    for changed descriptions and bulk POSTs for new addresses.
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        matched_arps (list): The ArpEntry for each address
+        subnets_info (list): The subnets the ARP entries were collected from
+
+    Returns:
+        dict: The addresses that were 'added', 'updated', 'unchanged', or 'failed'
+    """
+    results = {'added': [], 'updated': [], 'unchanged': [], 'failed': []}
+    # If an address shows up on more than one device, the last one wins
+    wanted_macs = {arp_entry.ip: arp_entry.mac for arp_entry in matched_arps}
+
+    existing_addresses = {}
+    subnets = [subnet['subnet'] for subnet in subnets_info]
+    for address in nb_conn.ipam.ip_addresses.filter(parent=subnets):
+        existing_addresses.setdefault(address.address.split("/")[0], address)
+
+    to_update = []
+    updated_ips = []
+    to_create = []
+    for ip_address, mac in wanted_macs.items():
+        queried_addr = existing_addresses.get(ip_address)
+        if not queried_addr:
+            to_create.append({"address": ip_address, "description": mac})
+        elif queried_addr.description != mac:
+            to_update.append({"id": queried_addr.id, "description": mac})
+            updated_ips.append(ip_address)
+        else:
+            results['unchanged'].append(ip_address)
+
+    updated = bulk_update(nb_conn.ipam.ip_addresses, to_update)
+    for ip_address, result in zip(updated_ips, updated):
+        results['updated' if result else 'failed'].append(ip_address)
+    created = bulk_create(nb_conn.ipam.ip_addresses, to_create)
+    for payload, result in zip(to_create, created):
+        results['added' if result else 'failed'].append(payload['address'])
+    return results
 
 def main():
     """
@@ -135,56 +216,35 @@ def main():
     device_creds = load_device_creds()
     subnets_info = load_subnet_info()
 
-    for device in devices_to_update:
-        if 'device_type' in device.keys():
-            conn = connect_to_device(device['mgmt_ip'], device_creds['username'],
-                                 device_creds['password'], device_type=device['device_type'])
-        else:
-            conn = connect_to_device(device['mgmt_ip'], device_creds['username'],
-                                     device_creds['password'])
-
-        # Ping everything in the subnets
-        # for subnet in subnets_info:
-        #     nodes = list(ipaddress.ip_network(subnet['subnet']).hosts())
-        #     for node in nodes:
-        #         output = conn.send_command(f"ping count=1 {format(node)}")
-
-        # Get the ARP table
-
-        matched_arps = mikrotik_get_arp_entries(conn, subnets_info)
-        conn.disconnect()
+    # Get the ARP tables from all the devices at once
+    arp_tables = collect_arp_tables(devices_to_update, device_creds, subnets_info)
 
+    matched_arps = []
+    for device in devices_to_update:
+        if device['name'] not in arp_tables:
+            continue
         # Tell Slack what you found
         arp_message = f"Found these addresses in the ARP table on {device['name']}.\n```"
-        for arp in matched_arps:
-            arp_message = arp_message + f"{arp['ip']}\n"
+        for arp in arp_tables[device['name']]:
+            arp_message = arp_message + f"{arp.ip}\n"
         arp_message = arp_message + "```"
         send_to_slack(arp_message, device_creds['slack_url'])
-
-        # Check Netbox for those IPs.
-        nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-        token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-        # Update Netbox
-        for arp_entry in matched_arps:
-            queried_addr = nb_conn.ipam.ip_addresses.get(address=arp_entry['ip'])
-            if queried_addr:
-                if not queried_addr.description == arp_entry['mac']:
-                    queried_addr.update({'description': arp_entry['mac']})
-                    send_to_slack(f"IP address `{arp_entry['ip']}`" \
-                        f"updated with MAC `{arp_entry['mac']}`.",
-                                  device_creds['slack_url'])
-            else:
-                added_address = nb_conn.ipam.ip_addresses.create({"address": arp_entry['ip'],
-                                                                  "description": arp_entry['mac']})
-                if added_address:
-                    send_to_slack(f"Adding `{arp_entry['ip']}` to Netbox.",
-                                  device_creds['slack_url'])
-                else:
-                    send_to_slack(f"Couldn't add address {arp_entry['ip']} for some reason.",
-                                  device_creds['slack_url'])
-
-        token.delete()
+        matched_arps.extend(arp_tables[device['name']])
+
+    # Check Netbox for those IPs.
+    nb_conn = netbox_session.connect(env_vars)
+
+    # Update Netbox
+    results = reconcile_addresses(nb_conn, matched_arps, subnets_info)
+    sync_message = f"Netbox sync: {len(results['added'])} added, " \
+        f"{len(results['updated'])} updated, {len(results['unchanged'])} unchanged."
+    if results['added']:
+        sync_message = sync_message + f"\nAdded: `{'`, `'.join(results['added'])}`"
+    if results['updated']:
+        sync_message = sync_message + f"\nUpdated with new MACs: `{'`, `'.join(results['updated'])}`"
+    if results['failed']:
+        sync_message = sync_message + f"\nCouldn't sync: `{'`, `'.join(results['failed'])}`"
+    send_to_slack(sync_message, device_creds['slack_url'])
 
 if __name__ == "__main__":
     main()
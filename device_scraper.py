@@ -0,0 +1,190 @@
+"""
+Logs into a bunch of devices at the same time and runs something on each of them
+
+Each device gets its own connect and command timeouts, and connections that time out or drop are
+retried with an exponential backoff. Bad passwords aren't retried since trying again won't fix
+them. The results come back together so the caller can update Netbox in one go.
+
+It also has the scrape for serial numbers and the Netbox lookup that go with it, since more than
+one script uses them.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from paramiko.ssh_exception import SSHException
+from netmiko import (ConnectHandler, NetmikoAuthenticationException, NetmikoTimeoutException,
+                     ReadTimeout)
+from device_output_parser import parse_routerboard
+from netbox_bulk import chunked
+
+# How many devices to work on at the same time
+MAX_WORKERS = 10
+# How long to wait on a device to connect or answer a command, in seconds
+DEVICE_TIMEOUT = 30
+# How many times to try a device before giving up on it
+MAX_ATTEMPTS = 3
+# How long to wait before the first retry, in seconds. It doubles after each one.
+RETRY_BACKOFF = 2.0
+# Errors that might go away if we try again. ReadTimeout is what a command that takes longer than
+# DEVICE_TIMEOUT raises.
+RETRYABLE_ERRORS = (NetmikoTimeoutException, ReadTimeout, SSHException, OSError, EOFError)
+# What each device in a devices file needs to be scraped. See yaml_loader.load_yaml().
+DEVICE_SCHEMA = {"name": str, "mgmt_ip": str}
+
+
+def connect_to_device(address: str, username: str, password: str,
+                      device_type:str="mikrotik_routeros",
+                      timeout: int = DEVICE_TIMEOUT) -> ConnectHandler:
+    """
+    Connect to the device via Netmiko using the info provided
+
+    Args:
+        address (str): The address of the device
+        username (str): The username
+        password (str): The password
+        device_type (str, optional): The Netmiko device type to use.
+          Defaults to "mikrotik_routeros".
+        timeout (int, optional): Seconds to wait to connect and for each command to finish.
+          Defaults to DEVICE_TIMEOUT.
+
+    Returns:
+        ConnectHandler: The Netmiko ConnectionHandler object to use to run commands
+    """
+    dev_conn = {
+        'device_type': device_type,
+        'host': address,
+        'username': username,
+        'password': password,
+        'conn_timeout': timeout,
+        'auth_timeout': timeout,
+        'banner_timeout': timeout,
+        'read_timeout_override': timeout,
+    }
+    return ConnectHandler(**dev_conn)
+
+
+def scrape_device(device: dict, device_creds: dict, scrape, timeout: int = DEVICE_TIMEOUT,
+                  attempts: int = MAX_ATTEMPTS, backoff: float = RETRY_BACKOFF,
+                  connect=connect_to_device):
+    """
+    Log into a device and run `scrape` on the connection, retrying if the connection fails
+
+    Args:
+        device (dict): The device info with at least 'name' and 'mgmt_ip'. Set 'device_type' to
+          use something other than the connect function's default.
+        device_creds (dict): The username and password for the device
+        scrape (callable): Called with the connection and the device. Whatever it returns is the
+          result for the device.
+        timeout (int, optional): Seconds to wait on the device. Defaults to DEVICE_TIMEOUT.
+        attempts (int, optional): How many times to try. Defaults to MAX_ATTEMPTS.
+        backoff (float, optional): Seconds to wait before the first retry.
+          Defaults to RETRY_BACKOFF.
+        connect (callable, optional): The function used to connect to the device.
+          Defaults to connect_to_device.
+
+    Returns:
+        Whatever `scrape` returned
+    """
+    connect_args = {'timeout': timeout}
+    if 'device_type' in device.keys():
+        connect_args['device_type'] = device['device_type']
+    for attempt in range(1, attempts + 1):
+        try:
+            conn = connect(device['mgmt_ip'], device_creds['username'], device_creds['password'],
+                           **connect_args)
+            try:
+                return scrape(conn, device)
+            finally:
+                conn.disconnect()
+        except NetmikoAuthenticationException:
+            raise
+        except RETRYABLE_ERRORS as err:
+            if attempt == attempts:
+                raise
+            print(f"Problem talking to {device['name']} ({err}). Trying again.")
+            time.sleep(backoff * 2 ** (attempt - 1))
+    return None
+
+
+def scrape_devices(devices: list, device_creds: dict, scrape, max_workers: int = MAX_WORKERS,
+                   **scrape_args) -> tuple:
+    """
+    Run scrape_device() on a bunch of devices at the same time
+
+    Args:
+        devices (list): The devices to log into
+        device_creds (dict): The username and password for the devices
+        scrape (callable): Called with the connection and the device for each device
+        max_workers (int, optional): How many devices to work on at once. Defaults to MAX_WORKERS.
+        **scrape_args: Passed on to scrape_device(), like `timeout` or `attempts`
+
+    Returns:
+        tuple: A dict of the results keyed by device name and a dict of the errors for the devices
+          that failed, also keyed by device name
+    """
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(scrape_device, device, device_creds, scrape, **scrape_args): device
+                   for device in devices}
+        for future in as_completed(futures):
+            device = futures[future]
+            try:
+                results[device['name']] = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                # Don't let one bad device sink the rest of them
+                errors[device['name']] = err
+    return results, errors
+
+
+def scrape_serial(connection: ConnectHandler, device: dict) -> dict:
+    """
+    Get the serial number from a Mikrotik device
+
+    Args:
+        connection (ConnectHandler): The Netmiko ConnectionHandler object to use
+        device (dict): The device info
+
+    Returns:
+        dict: The scraped info with the keys 'model' and 'serial', which are missing if the device
+          didn't report them
+    """
+    print(f"Scraping {device['name']} for update.")
+    output = connection.send_command("/system/routerboard/print")
+    routerboard = parse_routerboard(output)
+    return {key: value for key, value in routerboard._asdict().items() if value is not None}
+
+
+def get_netbox_devices(nb_conn, names: list) -> dict:
+    """
+    Get the Netbox devices with the given names, a chunk of names per query
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        names (list): The device names
+
+    Returns:
+        dict: The device records keyed by name
+    """
+    devices = {}
+    for chunk in chunked(names):
+        for device in nb_conn.dcim.devices.filter(name=chunk):
+            devices[device.name] = device
+    return devices
+
+
+def get_netbox_devices_by_id(nb_conn, ids: list) -> dict:
+    """
+    Get the Netbox devices with the given IDs, a chunk of IDs per query
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        ids (list): The device IDs
+
+    Returns:
+        dict: The device records keyed by ID. IDs that aren't in Netbox are left out.
+    """
+    devices = {}
+    for chunk in chunked(ids):
+        for device in nb_conn.dcim.devices.filter(id=chunk):
+            devices[device.id] = device
+    return devices
@@ -1,12 +1,12 @@
-import yaml
 import logging
+from yaml_loader import load_yaml
 
 SITES_FILE = "sites.yml"
 
 logging.basicConfig(level=logging.DEBUG)
 
-with open(SITES_FILE) as file:
-    sites_to_load = yaml.safe_load(file)
+# No schema since finding the sites with missing fields is the point
+sites_to_load = load_yaml(SITES_FILE)
     
 for site in sites_to_load:
     if not "time_zone" in site.keys():
@@ -1,5 +1,5 @@
-import yaml
 import logging
+from yaml_loader import load_yaml
 
 SITES_FILE = "sites.yml"
 LOG_FILE = "check_sites.log"
@@ -9,8 +9,8 @@ logging.basicConfig(filename=LOG_FILE,
                     level=logging.DEBUG,
                     format=LOG_FORMAT)
 
-with open(SITES_FILE) as file:
-    sites_to_load = yaml.safe_load(file)
+# No schema since finding the sites with missing fields is the point
+sites_to_load = load_yaml(SITES_FILE)
     
 for site in sites_to_load:
     if not "name" in site.keys():
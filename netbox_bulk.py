@@ -0,0 +1,154 @@
+"""
+Helpers for sending objects to Netbox in chunks instead of one request per object
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pynetbox
+
+BULK_CHUNK_SIZE = 200
+
+
+def chunked(items: list, chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Split a list into chunks
+
+    Args:
+        items (list): The things to split up
+        chunk_size (int, optional): The most items in a chunk. Defaults to BULK_CHUNK_SIZE.
+
+    Yields:
+        list: The next chunk of items
+    """
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def bulk_create(endpoint, payloads: list, chunk_size: int = BULK_CHUNK_SIZE,
+                logger: logging.Logger = None) -> list:
+    """
+    Create objects in Netbox with one POST per chunk of payloads
+
+    Netbox creates a list all-or-nothing, so if a chunk is rejected, the items in that chunk are
+    retried one at a time. That way a single bad item gets reported without dropping the rest.
+
+    Args:
+        endpoint (pynetbox.core.endpoint.Endpoint): The endpoint to create the objects in
+        payloads (list): The dictionaries describing the objects to create
+        chunk_size (int, optional): How many objects to send per request.
+          Defaults to BULK_CHUNK_SIZE.
+        logger (logging.Logger, optional): Where to report failures. Defaults to the root logger.
+
+    Returns:
+        list: The created records in the same order as `payloads`, with None for anything that
+          failed
+    """
+    logger = logger or logging.getLogger()
+    results = []
+    for chunk in chunked(payloads, chunk_size):
+        try:
+            results.extend(endpoint.create(chunk))
+            continue
+        except pynetbox.RequestError as err:
+            logger.error(f"Bulk create of {len(chunk)} objects was rejected ({err.error}). "
+                         "Retrying them one at a time.")
+        for payload in chunk:
+            try:
+                results.append(endpoint.create(payload))
+            except pynetbox.RequestError as err:
+                logger.error(f"Couldn't create {payload}: {err.error}")
+                results.append(None)
+    return results
+
+
+def bulk_update(endpoint, changes: list, chunk_size: int = BULK_CHUNK_SIZE,
+                logger: logging.Logger = None) -> list:
+    """
+    Update objects in Netbox with one PATCH per chunk of changes
+
+    Just like bulk_create, a rejected chunk is retried one item at a time so a single bad item
+    doesn't drop the rest.
+
+    Args:
+        endpoint (pynetbox.core.endpoint.Endpoint): The endpoint the objects live in
+        changes (list): Dictionaries with the `id` of each object and the fields to change
+        chunk_size (int, optional): How many objects to send per request.
+          Defaults to BULK_CHUNK_SIZE.
+        logger (logging.Logger, optional): Where to report failures. Defaults to the root logger.
+
+    Returns:
+        list: The updated records in the same order as `changes`, with None for anything that
+          failed
+    """
+    logger = logger or logging.getLogger()
+    results = []
+    for chunk in chunked(changes, chunk_size):
+        try:
+            results.extend(endpoint.update(chunk))
+            continue
+        except pynetbox.RequestError as err:
+            logger.error(f"Bulk update of {len(chunk)} objects was rejected ({err.error}). "
+                         "Retrying them one at a time.")
+        for change in chunk:
+            try:
+                results.extend(endpoint.update([change]))
+            except pynetbox.RequestError as err:
+                logger.error(f"Couldn't update {change}: {err.error}")
+                results.append(None)
+    return results
+
+
+def _delete_chunk(endpoint, chunk: list, logger: logging.Logger) -> list:
+    """
+    Delete one chunk of objects, falling back to one at a time if Netbox rejects the chunk
+
+    Args:
+        endpoint (pynetbox.core.endpoint.Endpoint): The endpoint the objects live in
+        chunk (list): The IDs of the objects to delete
+        logger (logging.Logger): Where to report failures
+
+    Returns:
+        list: The IDs that were deleted
+    """
+    try:
+        endpoint.delete(chunk)
+        return list(chunk)
+    except pynetbox.RequestError as err:
+        logger.error(f"Bulk delete of {len(chunk)} objects was rejected ({err.error}). "
+                     "Retrying them one at a time.")
+    deleted = []
+    for object_id in chunk:
+        try:
+            endpoint.delete([object_id])
+            deleted.append(object_id)
+        except pynetbox.RequestError as err:
+            logger.error(f"Couldn't delete {object_id}: {err.error}")
+    return deleted
+
+
+def bulk_delete(endpoint, ids: list, chunk_size: int = BULK_CHUNK_SIZE, max_workers: int = 1,
+                logger: logging.Logger = None) -> list:
+    """
+    Delete objects from Netbox with one DELETE per chunk of IDs
+
+    Just like bulk_create, a rejected chunk is retried one item at a time so a single bad item
+    doesn't keep the rest around. With `max_workers` above 1, chunks are sent in parallel.
+
+    Args:
+        endpoint (pynetbox.core.endpoint.Endpoint): The endpoint the objects live in
+        ids (list): The IDs of the objects to delete
+        chunk_size (int, optional): How many objects to send per request.
+          Defaults to BULK_CHUNK_SIZE.
+        max_workers (int, optional): How many chunks to send at once. Defaults to 1.
+        logger (logging.Logger, optional): Where to report failures. Defaults to the root logger.
+
+    Returns:
+        list: The IDs that were deleted
+    """
+    logger = logger or logging.getLogger()
+    chunks = list(chunked(ids, chunk_size))
+    if max_workers <= 1 or len(chunks) <= 1:
+        results = [_delete_chunk(endpoint, chunk, logger) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(lambda chunk: _delete_chunk(endpoint, chunk, logger), chunks)
+    return [object_id for deleted in results for object_id in deleted]
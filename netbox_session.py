@@ -0,0 +1,176 @@
+"""
+Shared Netbox connection for the scripts
+
+Instead of creating a token at startup and deleting it at exit, scripts reuse a token cached in
+TOKEN_CACHE_FILE until it's close to expiring. Every request goes through one requests.Session with
+keep-alive and a connection pool big enough for the threaded scripts. If Netbox rejects the cached
+token (say the token cleanup script deleted it), a new one is created and the request is retried.
+"""
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+import pynetbox
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+ENV_FILE = "env.yml"
+TOKEN_CACHE_FILE = ".netbox_token.json"
+# How long the tokens we create are good for
+TOKEN_LIFETIME = timedelta(hours=12)
+# Get a new token when the cached one has less than this left
+TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
+# How many connections to keep open to Netbox
+POOL_SIZE = 20
+# What Netbox says when it doesn't like a token
+REJECTED_TOKEN_MESSAGES = ("Invalid token", "Token expired")
+
+
+class NetboxSession(requests.Session):
+    """
+    requests.Session with a sized connection pool that gets a fresh token and retries once when
+    Netbox rejects the one it has
+    """
+    def __init__(self, pool_size: int = POOL_SIZE):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.nb_conn = None
+        self.env_vars = None
+        self.token_info = None
+        self._token_lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):  # pylint: disable=arguments-differ
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code != 403 or not self.token_info:
+            return response
+        if not any(message in response.text for message in REJECTED_TOKEN_MESSAGES):
+            return response
+        headers = dict(kwargs.get("headers") or {})
+        auth_header = next((key for key in headers if key.lower() == "authorization"), None)
+        if not auth_header:
+            return response
+
+        rejected_token = headers[auth_header].split()[-1]
+        with self._token_lock:
+            # Another thread may have already replaced it
+            if self.token_info['token'] == rejected_token:
+                self.refresh_token()
+        headers[auth_header] = headers[auth_header].replace(rejected_token,
+                                                            self.token_info['token'])
+        kwargs['headers'] = headers
+        return super().request(method, url, *args, **kwargs)
+
+    def refresh_token(self) -> None:
+        """
+        Create a new token that expires after TOKEN_LIFETIME and cache it
+        """
+        token = self.nb_conn.create_token(self.env_vars['username'], self.env_vars['password'])
+        expires = datetime.now(timezone.utc) + TOKEN_LIFETIME
+        # Set an expiration so tokens from dead scripts clean themselves up
+        token.update({"expires": expires.isoformat()})
+        self.token_info = {"id": token.id, "token": self.nb_conn.token,
+                           "expires": expires.isoformat()}
+        _save_cached_token(self.nb_conn.base_url, self.token_info)
+
+
+def _load_cached_token(base_url: str) -> dict:
+    """
+    Get the cached token for a Netbox instance
+
+    Args:
+        base_url (str): The API URL of the Netbox instance
+
+    Returns:
+        dict: The token's 'id', 'token', and 'expires', or None if there isn't one cached
+    """
+    if not os.path.exists(TOKEN_CACHE_FILE):
+        return None
+    with open(TOKEN_CACHE_FILE, encoding="UTF-8") as file:
+        return json.load(file).get(base_url)
+
+
+def _save_cached_token(base_url: str, token_info: dict) -> None:
+    """
+    Cache the token for a Netbox instance. The file is only readable by you since it holds a
+    working API token.
+
+    Args:
+        base_url (str): The API URL of the Netbox instance
+        token_info (dict): The token's 'id', 'token', and 'expires'
+    """
+    cached_tokens = {}
+    if os.path.exists(TOKEN_CACHE_FILE):
+        with open(TOKEN_CACHE_FILE, encoding="UTF-8") as file:
+            cached_tokens = json.load(file)
+    cached_tokens[base_url] = token_info
+    descriptor = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(descriptor, "w", encoding="UTF-8") as file:
+        json.dump(cached_tokens, file)
+
+
+def _token_is_fresh(token_info: dict) -> bool:
+    """
+    See if a cached token has enough time left on it to use
+
+    Args:
+        token_info (dict): The token's 'id', 'token', and 'expires'
+
+    Returns:
+        bool: Whether the token can be used
+    """
+    if not token_info:
+        return False
+    if not token_info.get('expires'):
+        return True
+    expires = datetime.fromisoformat(token_info['expires'])
+    return expires - TOKEN_REFRESH_MARGIN > datetime.now(timezone.utc)
+
+
+def connect(env_vars: dict = None, pool_size: int = POOL_SIZE,
+            threaded: bool = False) -> pynetbox.api:
+    """
+    Connect to Netbox with the cached token, getting a new one only if it's missing or about to
+    expire
+
+    Args:
+        env_vars (dict, optional): The Netbox URL, username, and password. Defaults to loading
+          them from ENV_FILE.
+        pool_size (int, optional): How many connections to keep open. Defaults to POOL_SIZE.
+        threaded (bool, optional): Have pynetbox fetch pages in parallel. Defaults to False.
+
+    Returns:
+        pynetbox.api: The Netbox connection
+    """
+    if env_vars is None:
+        with open(ENV_FILE, encoding="UTF-8") as file:
+            env_vars = yaml.safe_load(file)
+    nb_conn = pynetbox.api(url=env_vars['netbox_url'], threading=threaded)
+    session = NetboxSession(pool_size=pool_size)
+    session.nb_conn = nb_conn
+    session.env_vars = env_vars
+    nb_conn.http_session = session
+
+    token_info = _load_cached_token(nb_conn.base_url)
+    if _token_is_fresh(token_info):
+        session.token_info = token_info
+        nb_conn.token = token_info['token']
+    else:
+        session.refresh_token()
+    return nb_conn
+
+
+def session_token_id(nb_conn: pynetbox.api) -> int:
+    """
+    Get the ID of the token a connection is using, so things like the token cleanup scripts
+    know not to delete it
+
+    Args:
+        nb_conn (pynetbox.api): A connection from connect()
+
+    Returns:
+        int: The token's ID
+    """
+    return nb_conn.http_session.token_info['id']
@@ -1,25 +1,19 @@
 """
 Deletes all API tokens from Netbox
 """
-import pynetbox
+import netbox_session
+import token_sweeper
 import yaml
 
 ENV_FILE = "env.yml"
+# Set to True to see how many tokens would be deleted without deleting them
+DRY_RUN = False
 
 with open(ENV_FILE) as file:
     env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
+nb_conn = netbox_session.connect(env_vars)
 
-my_token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-all_tokens = nb_conn.users.tokens.all()
-
-for token in all_tokens:
-    if token.id == my_token.id:
-        print("Don't delete your own token, silly person!")
-        continue
-    print(f"Deleting token {token.id}")
-    token.delete()
-
-my_token.delete()
\ No newline at end of file
+# Your own token is skipped, so don't worry about that
+report = token_sweeper.sweep_tokens(nb_conn, dry_run=DRY_RUN)
+print(token_sweeper.format_report(report))
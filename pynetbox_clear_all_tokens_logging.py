@@ -1,13 +1,16 @@
 """
 Deletes all API tokens from Netbox
 """
-import pynetbox
+import netbox_session
+import token_sweeper
 import yaml
 import logging
 
 ENV_FILE = "env.yml"
 LOGFILE = "clear_token.log"
 LOG_FORMAT = '%(asctime)s - %(module)s - %(message)s'
+# Set to True to log what would be deleted without deleting it
+DRY_RUN = False
 
 logging.basicConfig(filename=LOGFILE,
                     level=logging.DEBUG,
@@ -16,17 +19,7 @@ logging.basicConfig(filename=LOGFILE,
 with open(ENV_FILE) as file:
     env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
+nb_conn = netbox_session.connect(env_vars)
 
-my_token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-all_tokens = nb_conn.users.tokens.all()
-
-for token in all_tokens:
-    if token.id == my_token.id:
-        logging.debug(f"Skipping {token.id} since it the one I'm using right now.")
-        continue
-    logging.debug(f"Deleting token {token.id}")
-    token.delete()
-
-my_token.delete()
\ No newline at end of file
+report = token_sweeper.sweep_tokens(nb_conn, dry_run=DRY_RUN)
+logging.info(token_sweeper.format_report(report))
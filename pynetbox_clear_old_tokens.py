@@ -1,41 +1,33 @@
 """
-Checks the last_used time on the Netbox API tokens and deletes those not used in the last TOKEN_AGE_LIMIT seconds.
+Deletes the Netbox API tokens that haven't been used in the last TOKEN_AGE_LIMIT seconds and shows
+how old all the tokens are.
 
-Watch out for timezone mismatches between the NB server and the local host!    
+The cutoff is sent to Netbox as a UTC timestamp, so the server and the local host don't need to be
+in the same timezone. Each token Netbox sends back is checked against the cutoff again before it's
+deleted. Tokens that have never been used are left alone.
 """
-import pynetbox
+import netbox_session
+import token_sweeper
 import yaml
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 
 ENV_FILE = "env.yml"
 
 TOKEN_AGE_LIMIT = 1209600  # 2 weeks in seconds
-NOW_TIME = datetime.now()
+# Set to True to see how many tokens would be deleted without deleting them
+DRY_RUN = False
 
 with open(ENV_FILE) as file:
     env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-
-my_token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-all_tokens = nb_conn.users.tokens.all()
-
-for token in all_tokens:
-    if token.id == my_token.id:
-        print("Don't delete your own token, silly person!")
-        continue
-    print(f"Token {token.id} ", end="")
-    if isinstance(token.last_used, type(None)):
-        print("has never been used...skipping.")
-        continue
-    time_diff = NOW_TIME - datetime.strptime(token.last_used, "%Y-%m-%dT%H:%M:%S.%fZ")
-    print(f"used {time_diff.seconds} seconds ago...", end="")
-    if time_diff.seconds > TOKEN_AGE_LIMIT:
-        print("deleting.")
-        token.delete()
-    else:
-        print("skipping.")
-
-my_token.delete()
\ No newline at end of file
+nb_conn = netbox_session.connect(env_vars)
+
+now_time = datetime.now(timezone.utc)
+print(token_sweeper.format_age_histogram(token_sweeper.token_age_histogram(nb_conn, now_time)))
+
+cutoff = now_time - timedelta(seconds=TOKEN_AGE_LIMIT)
+print(f"Deleting tokens last used before {cutoff:%Y-%m-%d %H:%M:%S} UTC.")
+stale_tokens = token_sweeper.find_stale_tokens(nb_conn, cutoff)
+report = token_sweeper.delete_tokens(nb_conn, stale_tokens, dry_run=DRY_RUN)
+print(token_sweeper.format_report(report))
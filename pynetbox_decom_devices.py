@@ -1,42 +1,96 @@
 """
 Deletes devices from Netbox after an indicated date in the description field
+
+Put something like "delete after 15 Mar 2024" (or "Delete after 5 March 2024") in the description of a
+device with a status of "decommissioning" and it'll be deleted the next time this runs after that
+date.
 """
 import re
 from datetime import datetime
-import pynetbox
+from functools import lru_cache
+import netbox_session
 import yaml
+from netbox_bulk import bulk_delete
 
 ENV_FILE = "env.yml"
+# Set to True to see what would be deleted without deleting anything
+DRY_RUN = False
+# "delete after 15 Mar 2024", anywhere in the description and in any case. Netbox's filter
+# doesn't care about case either.
+DELETE_AFTER_TEXT = "delete after"
+DELETE_AFTER_PATTERN = re.compile(r"delete after\s+(\d{1,2}\s+[A-Za-z]+\s+\d{4})", re.IGNORECASE)
+# The ways the date can be written, like "15 Mar 2024" or "15 March 2024"
+DELETE_DATE_FORMATS = ('%d %b %Y', '%d %B %Y')
+
+
+@lru_cache(maxsize=None)
+def parse_delete_date(date_text: str) -> datetime:
+    """
+    Turn the date from a description into a datetime. A lot of devices share the same date, so
+    each one is only parsed once.
+
+    Args:
+        date_text (str): The date, like "15 Mar 2024"
+
+    Returns:
+        datetime: The date, or None if it isn't a real date
+    """
+    date_text = " ".join(date_text.split())
+    for date_format in DELETE_DATE_FORMATS:
+        try:
+            return datetime.strptime(date_text, date_format)
+        except ValueError:
+            continue
+    return None
+
 
 # Load the environment information
 with open(ENV_FILE, encoding="UTF-8") as file:
     env_vars = yaml.safe_load(file)
 # Connect to Netbox and get a token
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-my_token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-# Get a list of all the devices with a status of "decommission"
-decommed_devices = nb_conn.dcim.devices.filter(status="decommissioning")
+nb_conn = netbox_session.connect(env_vars)
+# Get the devices with a status of "decommission" that have a "delete after" date. They come in
+# a page at a time as we go through them.
+decommed_devices = nb_conn.dcim.devices.filter(status="decommissioning",
+                                               description__ic="delete after")
 # Get today's date to do some math on later
 todays_date = datetime.now()
-# Go through the list of devices returned
+checked = 0
+bad_dates = []
+expired_devices = {}
+# Go through the devices returned. Don't delete anything yet since that would shift the pages.
 for decommed_device in decommed_devices:
-    # Do a regex search for "delete after " with some text
-    date_search = re.search("delete after (.+)", decommed_device.description)
-    # If you found a match to the regex
-    if date_search:
-        # Format the "delete after" date
-        delete_date = datetime.strptime(date_search.group(1), '%d %b %Y')
-        # If today's date is after the "delete after" date
-        if todays_date > delete_date:
-            # Tell us we're going to delete stuff
-            print(f"Deleting the device {decommed_device.name}...", end="")
-            # Delete the device. You should get a True back
-            result = decommed_device.delete()
-            # If everything went fine
-            if result:
-                print("...deleted.")
-            # If it didn't delete
-            else:
-                print("failed.")
-# Delete the token we're using to work with Netbox
-my_token.delete()
+    checked += 1
+    # Look for "delete after " and a date. The description might be empty.
+    description = decommed_device.description or ""
+    if DELETE_AFTER_TEXT not in description.lower():
+        continue
+    date_search = DELETE_AFTER_PATTERN.search(description)
+    delete_date = parse_delete_date(date_search.group(1)) if date_search else None
+    if delete_date is None:
+        bad_dates.append(decommed_device.name)
+    # If today's date is after the "delete after" date
+    elif todays_date > delete_date:
+        expired_devices[decommed_device.id] = decommed_device.name
+
+for device_name in bad_dates:
+    print(f"Couldn't read the delete after date on {device_name}. Skipping.")
+
+# Delete the expired devices in bulk
+if DRY_RUN:
+    for device_name in expired_devices.values():
+        print(f"Would delete the device {device_name}.")
+    deleted = []
+else:
+    deleted = bulk_delete(nb_conn.dcim.devices, list(expired_devices))
+    for device_id in deleted:
+        print(f"Deleted the device {expired_devices[device_id]}.")
+
+print(f"Checked {checked} decommissioning devices. {len(expired_devices)} were past their delete "
+      f"after date and {len(deleted)} were deleted.", end="")
+failed = len(expired_devices) - len(deleted)
+if failed and not DRY_RUN:
+    print(f" {failed} couldn't be deleted.", end="")
+if bad_dates:
+    print(f" {len(bad_dates)} had a date that couldn't be read.", end="")
+print()
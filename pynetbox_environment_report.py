@@ -2,6 +2,7 @@
 Generates a summary of the Python and Netbox environment to include in blog posts
 """
 import pynetbox
+import netbox_session
 import yaml
 import sys
 
@@ -15,11 +16,9 @@ print(f"{'Python':<15}: {sys.version.split()[0]:^8}")
 # Print pynetbox version
 print(f"{'Pynetbox':<15}: {pynetbox.__version__:^8}")
     
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
+nb_conn = netbox_session.connect(env_vars)
 
 print(f"{'Netbox version':<15}: {nb_conn.status()['netbox-version']:^8}")
 
 
 
-token.delete()
\ No newline at end of file
@@ -7,13 +7,206 @@ TODO:
     - Fix node/edge addition for name of device
 """
 
+import hashlib
+import ipaddress
+import json
+import os
 import pynetbox
+import netbox_session
 import yaml
 import graphviz
 import logging
 
 ENV_FILE = "env.yml"
 CREDS_FILE = "device_creds.yml"
+# Where to keep what the topology looked like last time and the hashes of what was rendered
+SNAPSHOT_FILE = "diagram_snapshot.json"
+
+
+class PrefixIndex:
+    """
+    Finds the longest (most specific) prefix an address falls in
+
+    Prefixes are kept in a table per prefix length keyed by network address, so a lookup is one
+    dictionary hit per distinct prefix length instead of a scan through every prefix.
+    """
+    def __init__(self, prefixes: list):
+        self._tables = {}
+        for prefix in prefixes:
+            network = ipaddress.ip_network(prefix.prefix)
+            table = self._tables.setdefault((network.version, network.prefixlen), {})
+            table[int(network.network_address)] = prefix
+        # Try the longest prefixes first
+        self._lengths = {4: [], 6: []}
+        for version, prefixlen in sorted(self._tables, key=lambda key: key[1], reverse=True):
+            self._lengths[version].append(prefixlen)
+
+    def longest_match(self, address: str):
+        """
+        Get the most specific prefix that contains an address
+
+        Args:
+            address (str): The address, with or without a mask
+
+        Returns:
+            pynetbox.Record: The matching prefix or None if it's not in any of them
+        """
+        ip_address = ipaddress.ip_interface(address).ip
+        max_bits = ip_address.max_prefixlen
+        address_int = int(ip_address)
+        for prefixlen in self._lengths[ip_address.version]:
+            network_int = address_int >> (max_bits - prefixlen) << (max_bits - prefixlen)
+            prefix = self._tables[(ip_address.version, prefixlen)].get(network_int)
+            if prefix:
+                return prefix
+        return None
+
+
+def build_topology(nb_conn: pynetbox.api, logger: logging.Logger) -> dict:
+    """
+    Work out which devices have addresses in which prefixes. This takes two paginated queries
+    (all prefixes and all addresses) no matter how big Netbox is.
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        logger (logging.Logger): The logger
+
+    Returns:
+        dict: The snapshot of the topology. 'prefixes' has the list of (device name, address)
+          for each prefix that has any. 'prefix_count', 'address_count',
+          and 'last_updated' are used to tell if Netbox has changed since.
+    """
+    snapshot = {"prefix_count": 0, "address_count": 0, "last_updated": "", "prefixes": {}}
+    prefixes = []
+    for prefix in nb_conn.ipam.prefixes.all():
+        snapshot['prefix_count'] += 1
+        snapshot['last_updated'] = max(snapshot['last_updated'], prefix.last_updated or "")
+        if prefix.status.value == "container":
+            logger.debug(f"Skipping {prefix} since it's a container.")
+            continue
+        prefixes.append(prefix)
+    prefix_index = PrefixIndex(prefixes)
+
+    prefix_addresses = {prefix.prefix: [] for prefix in prefixes}
+    for address in nb_conn.ipam.ip_addresses.all():
+        snapshot['address_count'] += 1
+        snapshot['last_updated'] = max(snapshot['last_updated'], address.last_updated or "")
+        # Check the type first. Asking a record for a field it doesn't have makes pynetbox go
+        # back to Netbox for the full object.
+        if address.assigned_object_type != "dcim.interface" or not address.assigned_object:
+            logger.debug(f"Skipping {address} since it's not assigned to a device.")
+            continue
+        assigned_device = address.assigned_object.device
+        prefix = prefix_index.longest_match(address.address)
+        if not prefix:
+            logger.debug(f"Skipping {address} since it's not in any prefix.")
+            continue
+        prefix_addresses[prefix.prefix].append((assigned_device.name, address.address))
+
+    for prefix in prefixes:
+        if prefix_addresses[prefix.prefix]:
+            snapshot['prefixes'][prefix.prefix] = {"addresses": prefix_addresses[prefix.prefix]}
+    return snapshot
+
+
+def load_snapshot() -> dict:
+    """
+    Load the snapshot from the last run
+
+    Returns:
+        dict: The snapshot, or an empty dict if there isn't one
+    """
+    if not os.path.exists(SNAPSHOT_FILE):
+        return {}
+    with open(SNAPSHOT_FILE, encoding="UTF-8") as file:
+        return json.load(file)
+
+
+def save_snapshot(snapshot: dict) -> None:
+    """
+    Save the snapshot for the next run
+
+    Args:
+        snapshot (dict): The topology snapshot and render hashes
+    """
+    with open(SNAPSHOT_FILE, "w", encoding="UTF-8") as file:
+        json.dump(snapshot, file, indent=2)
+
+
+def netbox_has_changed(nb_conn: pynetbox.api, snapshot: dict) -> bool:
+    """
+    See if the prefixes or addresses in Netbox have changed since the snapshot was taken. This
+    only asks for counts, so it's a handful of tiny queries instead of pulling everything.
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        snapshot (dict): The snapshot from the last run
+
+    Returns:
+        bool: Whether the topology needs to be pulled again
+    """
+    # An empty topology is fine, but a snapshot without one (or no snapshot at all) isn't
+    if 'prefixes' not in snapshot:
+        return True
+    # Deletes don't show up in last_updated, but they do change the counts
+    if nb_conn.ipam.prefixes.count() != snapshot['prefix_count']:
+        return True
+    if nb_conn.ipam.ip_addresses.count() != snapshot['address_count']:
+        return True
+    last_updated = snapshot['last_updated']
+    if nb_conn.ipam.prefixes.count(last_updated__gt=last_updated):
+        return True
+    return nb_conn.ipam.ip_addresses.count(last_updated__gt=last_updated) > 0
+
+
+def build_graph(prefixes: dict, logger: logging.Logger) -> graphviz.Graph:
+    """
+    Turn the topology into a graph
+
+    Args:
+        prefixes (dict): The 'prefixes' from a topology snapshot
+        logger (logging.Logger): The logger
+
+    Returns:
+        graphviz.Graph: The network diagram
+    """
+    graph = graphviz.Graph("Network Diagram", engine="neato")
+    graph.graph_attr['overlap'] = "False"
+    graph.graph_attr['splines'] = "curved"
+
+    for prefix, prefix_info in prefixes.items():
+        logger.debug(f"Adding {prefix} to the diagram.")
+        graph.node(prefix, style="filled", fillcolor="brown")
+        for device_name, address in prefix_info['addresses']:
+            logger.debug(f"Adding {device_name} as a node.")
+            graph.node(device_name, shape="rectangle", style="filled", fillcolor="green")
+            logger.debug(f"Adding an edge from {address} to {prefix}")
+            graph.edge(device_name, prefix, taillabel=address, fontsize="8pt")
+    return graph
+
+
+def render_if_changed(graph: graphviz.Graph, render_hashes: dict, key: str,
+                      logger: logging.Logger, view: bool = False) -> None:
+    """
+    Render a graph unless it's exactly what was rendered last time. Laying out the graph is the
+    slow part, so skipping it when nothing changed is the big win.
+
+    Args:
+        graph (graphviz.Graph): The graph to render
+        render_hashes (dict): The source hashes from the last run. Updated in place.
+        key (str): What this graph is called in `render_hashes`
+        logger (logging.Logger): The logger
+        view (bool, optional): Open the rendered diagram. Defaults to False.
+    """
+    source_hash = hashlib.sha256(graph.source.encode("UTF-8")).hexdigest()
+    rendered_file = f"{graph.filepath}.{graph.format}"
+    if render_hashes.get(key) == source_hash and os.path.exists(rendered_file):
+        logger.info(f"The diagram for {key} hasn't changed. Not rendering it.")
+        return
+    logger.info(f"Rendering the diagram for {key}.")
+    graph.render(view=view)
+    render_hashes[key] = source_hash
+
 
 def main():
     """
@@ -35,44 +228,24 @@ def main():
     with open(CREDS_FILE, encoding="UTF-8") as file:
         creds = yaml.safe_load(file)
     # Connect to NB
-    nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-    # Create a token
-    my_token = nb_conn.create_token(env_vars['username'], env_vars['password'])
+    nb_conn = netbox_session.connect(env_vars)
 
-    # The graph
-    graph = graphviz.Graph("Network Diagram", engine="neato")
-    graph.graph_attr['overlap'] = "False"
-    graph.graph_attr['splines'] = "curved"
-
-    # The prefixes in NB
-    nb_prefixes = nb_conn.ipam.prefixes.all()
-
-    for prefix in nb_prefixes:
-        if prefix.status.value == "container":
-            logger.debug(f"Skipping {prefix} since it's a container.")
-            continue
-        prefix_addresses = nb_conn.ipam.ip_addresses.filter(parent=prefix.prefix)
-        if len(prefix_addresses) < 1:
-            logger.debug(f"{prefix} doesn't have any children. Skipping.")
-            continue
-        else:
-            logger.debug(f"Adding {prefix} to the diagram.")
-            # graph.node(prefix.prefix, label=prefix.prefix, name=prefix.prefix)
-            graph.node(prefix.prefix, style="filled", fillcolor="brown")
-        for address in prefix_addresses:
-            logger.debug(f"Adding {address} as a node.")
-            graph.node(address.assigned_object.device.name, shape="rectangle", style="filled", fillcolor="green")
-            logger.debug(f"Adding an edge from {address.address} to {prefix.prefix}")
-            # graph.edge(address.assigned_object.device.name, prefix.prefix, taillabel=address.address, arrowhead="none", fontsize="8pt")
-            graph.edge(address.assigned_object.device.name, prefix.prefix, taillabel=address.address, fontsize="8pt")
+    # Only pull the prefixes and addresses again if Netbox has changed since last time
+    snapshot = load_snapshot()
+    render_hashes = snapshot.get('render_hashes', {})
+    if netbox_has_changed(nb_conn, snapshot):
+        logger.info("Netbox has changed since the last run. Pulling the topology.")
+        snapshot = build_topology(nb_conn, logger)
+    else:
+        logger.info("Netbox hasn't changed since the last run. Using the saved topology.")
 
+    graph = build_graph(snapshot['prefixes'], logger)
     logger.debug(graph.source)
-    graph.render(view=True)
+    render_if_changed(graph, render_hashes, graph.name, logger, view=True)
 
-    # Delete the token we created
-    my_token.delete()
+    snapshot['render_hashes'] = render_hashes
+    save_snapshot(snapshot)
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,7 +1,7 @@
 """
 Show planned devices in Netbox grouped by site
 """
-import pynetbox
+import netbox_session
 import yaml
 import requests
 
@@ -10,8 +10,7 @@ ENV_FILE = "env.yml"
 with open(ENV_FILE) as file:
     env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
+nb_conn = netbox_session.connect(env_vars)
 
 choices = nb_conn.dcim.devices.choices()['status']
 
@@ -21,4 +20,3 @@ for status in choices:
     
 print (valid_statuses)
 
-token.delete()
\ No newline at end of file
@@ -2,27 +2,71 @@
 Show all devices in Netbox grouped by site
 """
 import pynetbox
+import netbox_session
 import yaml
 
 ENV_FILE = "env.yml"
 
-with open(ENV_FILE) as file:
-    env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
+def get_devices_by_site(nb_conn: pynetbox.api, status: str = None) -> dict:
+    """
+    Get the devices from Netbox in one paginated sweep and group them by site
 
-sites = nb_conn.dcim.sites.all()
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        status (str, optional): Only get devices with this status. Defaults to all devices.
 
-for site in sites:
-    site_header = f"\nDevices at site {site.name} ({site.description})"
-    print(site_header)
-    print("-" * len(site_header))
-    devices = nb_conn.dcim.devices.filter(site_id=site.id)
-    if len(devices) < 1:
-        print("No devices.")
-        continue
+    Returns:
+        dict: Lists of devices keyed by site ID
+    """
+    if status:
+        devices = nb_conn.dcim.devices.filter(status=status)
+    else:
+        devices = nb_conn.dcim.devices.all()
+    devices_by_site = {}
     for device in devices:
-        print(f"{device.name:^20} {device.device_role.name:^20}")
-        
-token.delete()
\ No newline at end of file
+        devices_by_site.setdefault(device.site.id, []).append(device)
+    return devices_by_site
+
+
+def print_site_report(nb_conn: pynetbox.api, status: str = None, header: str = "Devices",
+                      empty_message: str = "No devices.") -> None:
+    """
+    Print the devices at each site. This takes two queries (sites and devices) no matter how many
+    sites there are.
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        status (str, optional): Only show devices with this status. Defaults to all devices.
+        header (str, optional): What to call the devices in each site's header.
+          Defaults to "Devices".
+        empty_message (str, optional): What to print for a site with no devices.
+          Defaults to "No devices.".
+    """
+    devices_by_site = get_devices_by_site(nb_conn, status=status)
+    for site in nb_conn.dcim.sites.all():
+        site_header = f"\n{header} at site {site.name} ({site.description})"
+        print(site_header)
+        print("-" * len(site_header))
+        devices = devices_by_site.get(site.id, [])
+        if len(devices) < 1:
+            print(empty_message)
+            continue
+        for device in devices:
+            print(f"{device.name:^20} {device.device_role.name:^20}")
+
+
+def main():
+    """
+    Run this
+    """
+    with open(ENV_FILE) as file:
+        env_vars = yaml.safe_load(file)
+
+    nb_conn = netbox_session.connect(env_vars)
+
+    print_site_report(nb_conn)
+
+
+if __name__ == "__main__":
+    main()
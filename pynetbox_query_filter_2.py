@@ -1,28 +1,25 @@
 """
 Show planned devices in Netbox grouped by site
 """
-import pynetbox
+import netbox_session
 import yaml
+from pynetbox_query_filter_1 import print_site_report
 
 ENV_FILE = "env.yml"
 
-with open(ENV_FILE) as file:
-    env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
+def main():
+    """
+    Run this
+    """
+    with open(ENV_FILE) as file:
+        env_vars = yaml.safe_load(file)
 
-sites = nb_conn.dcim.sites.all()
+    nb_conn = netbox_session.connect(env_vars)
 
-for site in sites:
-    site_header = f"\nPlanned devices at site {site.name} ({site.description})"
-    print(site_header)
-    print("-" * len(site_header))
-    devices = nb_conn.dcim.devices.filter(site_id=site.id, status="planned")
-    if len(devices) < 1:
-        print("No planned devices.")
-        continue
-    for device in devices:
-        print(f"{device.name:^20} {device.device_role.name:^20}")
-        
-token.delete()
\ No newline at end of file
+    print_site_report(nb_conn, status="planned", header="Planned devices",
+                      empty_message="No planned devices.")
+
+
+if __name__ == "__main__":
+    main()
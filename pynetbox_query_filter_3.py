@@ -2,20 +2,102 @@
 Create a shipping label for planned devices
 """
 import pynetbox
+import netbox_session
 import yaml
 
 ENV_FILE = "env.yml"
+# Set this to a file name to write the labels there instead of printing them
+LABEL_FILE = None
+# How many labels to write to LABEL_FILE at a time
+LABEL_BATCH_SIZE = 50
 
-with open(ENV_FILE) as file:
-    env_vars = yaml.safe_load(file)
 
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
+class SiteLookup:
+    """
+    Gets sites from Netbox by ID, remembering the ones it's already seen. A bunch of devices
+    going to a handful of sites only costs one query per site.
+    """
+    def __init__(self, nb_conn: pynetbox.api):
+        self.nb_conn = nb_conn
+        self._sites = {}
 
-devices = nb_conn.dcim.devices.filter(status='planned')
+    def get(self, site_id: int):
+        """
+        Get a site by ID
 
-for device in devices:
-    site = nb_conn.dcim.sites.get(id=device.site.id)
-    print(f"Ship {device.name} to:\n{site.physical_address}\n")
-        
-token.delete()
\ No newline at end of file
+        Args:
+            site_id (int): The ID of the site
+
+        Returns:
+            pynetbox.Record: The site
+        """
+        if site_id not in self._sites:
+            self._sites[site_id] = self.nb_conn.dcim.sites.get(id=site_id)
+        return self._sites[site_id]
+
+
+def generate_labels(nb_conn: pynetbox.api, site_lookup: SiteLookup = None):
+    """
+    Make a shipping label for each planned device as it comes back from Netbox
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        site_lookup (SiteLookup, optional): The site lookup to use. Defaults to a new one.
+
+    Yields:
+        str: The next shipping label
+    """
+    site_lookup = site_lookup or SiteLookup(nb_conn)
+    for device in nb_conn.dcim.devices.filter(status='planned'):
+        site = site_lookup.get(device.site.id)
+        yield f"Ship {device.name} to:\n{site.physical_address}\n"
+
+
+def write_labels(labels, label_file: str, batch_size: int = LABEL_BATCH_SIZE) -> int:
+    """
+    Write labels to a file a batch at a time so the printing pipeline can pick them up as they go
+
+    Args:
+        labels (iterable): The labels to write
+        label_file (str): The file to write them to
+        batch_size (int, optional): How many labels to write at once.
+          Defaults to LABEL_BATCH_SIZE.
+
+    Returns:
+        int: How many labels were written
+    """
+    written = 0
+    batch = []
+    with open(label_file, "w", encoding="UTF-8") as file:
+        for label in labels:
+            batch.append(label + "\n")
+            if len(batch) >= batch_size:
+                file.writelines(batch)
+                file.flush()
+                written += len(batch)
+                batch = []
+        file.writelines(batch)
+        written += len(batch)
+    return written
+
+
+def main():
+    """
+    Run this
+    """
+    with open(ENV_FILE) as file:
+        env_vars = yaml.safe_load(file)
+
+    nb_conn = netbox_session.connect(env_vars)
+
+    labels = generate_labels(nb_conn)
+    if LABEL_FILE:
+        count = write_labels(labels, LABEL_FILE)
+        print(f"Wrote {count} labels to {LABEL_FILE}.")
+    else:
+        for label in labels:
+            print(label)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,19 @@
-import pynetbox
+"""
+Logs into the devices and gets their serial numbers, then updates Netbox with any that changed.
+
+All the devices are scraped at the same time (see `device_scraper.py`) before Netbox is touched,
+and the changed serials go back in bulk. What was scraped is kept in a local cache (see
+`scrape_cache.py`), so devices scraped within the TTL are skipped. The serials are always checked
+against Netbox, but devices we already know the Netbox ID of are fetched by ID instead of by
+name.
+"""
+import netbox_session
 import yaml
-from netmiko import ConnectHandler
-import re
+from device_scraper import (DEVICE_SCHEMA, get_netbox_devices, get_netbox_devices_by_id,
+                            scrape_devices, scrape_serial)
+from netbox_bulk import bulk_update
+from scrape_cache import ScrapeCache
+from yaml_loader import load_yaml
 
 ENV_FILE = "env.yml"
 DEVICES_FILE = "devices_to_update.yml"
@@ -12,50 +24,78 @@ def load_env_vars():
         return yaml.safe_load(file)
 
 def load_devices():
-    with open(DEVICES_FILE) as file:
-        return yaml.safe_load(file)
-    
+    return load_yaml(DEVICES_FILE, DEVICE_SCHEMA)
+
 def load_device_creds():
     with open(DEVICE_CREDS_FILE) as file:
         return yaml.safe_load(file)
 
-env_vars = load_env_vars()
-devices_to_update = load_devices()
-device_creds = load_device_creds()
-
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-for device in devices_to_update:
-    print(f"Scraping {device['name']} for update.")
-    dev_conn = {
-        'device_type': 'mikrotik_routeros',
-        'host': device['mgmt_ip'],
-        'username': device_creds['username'],
-        'password': device_creds['password']
-    }
-    conn = ConnectHandler(**dev_conn)
-    output = conn.send_command("/system/routerboard/print")
-    conn.disconnect()
-    
-    scraped_info = {}
-    
-    lines = output.split("\n")
-    
-    for line in lines:
-        m = re.match(".+serial-number: (\S+)", line)
-        if m:
-            scraped_info['serial'] = m.group(1)
-            
-    queried_device = nb_conn.dcim.devices.get(name=device['name'])
-    if isinstance(queried_device, type(None)):
-        print(f"The device {device['name']} doesn't exist. Skipping.")
-        continue
-    if queried_device['serial'] == scraped_info['serial']:
-        print(f"The serials match. No changes.")
-    else:
-        print(f"Updating the serial number for {device['name']}.")
-        queried_device.update({"serial": scraped_info['serial']})
-
-
-token.delete()
\ No newline at end of file
+def main():
+    """
+    Run this
+    """
+    env_vars = load_env_vars()
+    devices_to_update = load_devices()
+    device_creds = load_device_creds()
+
+    with ScrapeCache() as cache:
+        stale_devices = [device for device in devices_to_update
+                         if not cache.is_fresh(device['name'])]
+        print(f"Skipping {len(devices_to_update) - len(stale_devices)} devices that were "
+              "scraped recently.")
+        if not stale_devices:
+            return
+
+        scraped, errors = scrape_devices(stale_devices, device_creds, scrape_serial)
+        for device_name, err in errors.items():
+            print(f"Couldn't get the serial from {device_name}: {err}")
+
+        if not scraped:
+            return
+        nb_conn = netbox_session.connect(env_vars)
+        # Check the serials against Netbox itself. Devices we know the ID of are fetched by ID,
+        # and the rest (or ones that were deleted or renamed since) are looked up by name.
+        known_ids = {device_name: (cache.get(device_name) or {}).get('netbox_id')
+                     for device_name in scraped}
+        devices_by_id = get_netbox_devices_by_id(
+            nb_conn, [netbox_id for netbox_id in known_ids.values() if netbox_id])
+        queried_devices = {}
+        for device_name, netbox_id in known_ids.items():
+            queried_device = devices_by_id.get(netbox_id)
+            if queried_device is not None and queried_device.name == device_name:
+                queried_devices[device_name] = queried_device
+        unknown_names = [device_name for device_name in scraped
+                         if device_name not in queried_devices]
+        if unknown_names:
+            queried_devices.update(get_netbox_devices(nb_conn, unknown_names))
+
+        changes = []
+        changed_names = []
+        for device_name, scraped_info in scraped.items():
+            queried_device = queried_devices.get(device_name)
+            if queried_device is None:
+                print(f"The device {device_name} doesn't exist. Skipping.")
+                cache.forget(device_name)
+                continue
+            if 'serial' not in scraped_info:
+                print(f"{device_name} didn't report a serial number. Skipping.")
+                continue
+            if queried_device.serial == scraped_info['serial']:
+                print(f"The serials match for {device_name}. No changes.")
+                cache.record(device_name, netbox_id=queried_device.id, **scraped_info)
+            else:
+                print(f"Updating the serial number for {device_name}.")
+                changes.append({"id": queried_device.id, "serial": scraped_info['serial']})
+                changed_names.append(device_name)
+
+        if not changes:
+            return
+        for device_name, result in zip(changed_names, bulk_update(nb_conn.dcim.devices, changes)):
+            if result:
+                cache.record(device_name, netbox_id=result.id, **scraped[device_name])
+            else:
+                # The device may have been deleted or renamed, so look it up again next time
+                cache.forget(device_name)
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,14 @@
 SSHes to the devices in question and get system information. If device is not in Netbox, it will
 add it with appropriate device_type and device_role. If it's in there already, it will make sure
 the type and role are set.
+
+The devices are scraped at the same time and the changes go back to Netbox in one bulk update.
 """
-import re
 import yaml
-import pynetbox
-from netmiko import ConnectHandler
+import netbox_session
+from device_scraper import DEVICE_SCHEMA, get_netbox_devices, scrape_devices, scrape_serial
+from netbox_bulk import bulk_update
+from yaml_loader import load_yaml
 
 
 ENV_FILE = "env.yml"
@@ -26,12 +29,12 @@ def load_env_vars():
 def load_devices():
     """
     Loads the `DEVICES_FILE` from disk as YAML and returns a dictionary of that content. This is
-    the file that contains information about what devices we're going to update.
+    the file that contains information about what devices we're going to update. Each one has to
+    have a name and management IP, and a manufacturer if its model might not be in Netbox yet.
     Returns:
         dict: The devices to update loaded from YAML
     """
-    with open(DEVICES_FILE, encoding="utf8") as file:
-        return yaml.safe_load(file)
+    return load_yaml(DEVICES_FILE, DEVICE_SCHEMA)
 
 def load_device_creds():
     """Loads the `DEVICE_CREDS_FILE` from disk as YAML and returns a dictionary of that content.
@@ -81,74 +84,106 @@ def add_device(connection, device_info):
     """
     return connection.dcim.devices.create(device_info)
 
-env_vars = load_env_vars()
-devices_to_update = load_devices()
-device_creds = load_device_creds()
-
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-for device in devices_to_update:
-    print(f"Scraping {device['name']} for update.")
-    dev_conn = {
-        'device_type': 'mikrotik_routeros',
-        'host': device['mgmt_ip'],
-        'username': device_creds['username'],
-        'password': device_creds['password']
-    }
-    conn = ConnectHandler(**dev_conn)
-    output = conn.send_command("/system/routerboard/print")
-    conn.disconnect()
-
-    scraped_info = {}
-
-    lines = output.split("\n")
-
-    for line in lines:
-        # Get the model
-        m = re.match(r".+model: (\S+)", line)
-        if m:
-            scraped_info['device_type'] = m.group(1)
+class DeviceTypeResolver:
+    """
+    Finds the Netbox manufacturers and device types for scraped devices, adding the ones that are
+    missing
+
+    Everything already in Netbox is loaded up front, and anything missing is only added once, no
+    matter how many devices turn out to be that model.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.manufacturers = {manufacturer.name: manufacturer
+                              for manufacturer in connection.dcim.manufacturers.all()}
+        self.device_types = {device_type.model: device_type
+                             for device_type in connection.dcim.device_types.all()}
+
+    def _manufacturer(self, name: str):
+        """
+        Get a manufacturer, adding it to Netbox if it isn't there
+
+        Args:
+            name (str): The manufacturer's name
+
+        Returns:
+            pynetbox.Record: The manufacturer
+        """
+        if name.upper() not in self.manufacturers:
+            print(f"Didn't find the manufacturer {name}. Adding.")
+            added_manufacturer_dict = {'name': name.upper(), 'slug': name.lower()}
+            self.manufacturers[name.upper()] = add_manufacturer(self.connection,
+                                                                added_manufacturer_dict)
+        return self.manufacturers[name.upper()]
+
+    def device_type(self, model: str, manufacturer_name: str = None):
+        """
+        Get a device type, adding it (and its manufacturer) to Netbox if it isn't there
+
+        Args:
+            model (str): The model of the device type
+            manufacturer_name (str, optional): Who makes it. It's only needed if the device type
+              has to be added.
+
+        Returns:
+            pynetbox.Record: The device type, or None if it has to be added and there's no
+              manufacturer to add it with
+        """
+        if model.upper() not in self.device_types:
+            if not manufacturer_name:
+                print(f"Didn't find the device type {model} and there's no manufacturer to add "
+                      "it with.")
+                return None
+            print(f"Didn't find the device type {model}. Adding.")
+            device_type = {'model': model.upper(),
+                           'slug': model.lower(),
+                           'manufacturer': self._manufacturer(manufacturer_name).id}
+            self.device_types[model.upper()] = add_device_type(self.connection, device_type)
+        return self.device_types[model.upper()]
+
+
+def main():
+    """
+    Run this
+    """
+    env_vars = load_env_vars()
+    devices_to_update = load_devices()
+    device_creds = load_device_creds()
+
+    scraped, errors = scrape_devices(devices_to_update, device_creds, scrape_serial)
+    for device_name, err in errors.items():
+        print(f"Couldn't update {device_name}: {err}")
+
+    nb_conn = netbox_session.connect(env_vars)
+    queried_devices = get_netbox_devices(nb_conn, list(scraped))
+    resolver = DeviceTypeResolver(nb_conn)
+    changes = []
+    for device in devices_to_update:
+        if device['name'] not in scraped:
             continue
-        # Get the serial
-        m = re.match(r".+serial-number: (\S+)", line)
-        if m:
-            scraped_info['serial'] = m.group(1)
+        scraped_info = scraped[device['name']]
+        queried_device = queried_devices.get(device['name'])
+        if isinstance(queried_device, type(None)):
+            print(f"The device {device['name']} doesn't exist. Skipping.")
             continue
 
-    queried_device = nb_conn.dcim.devices.get(name=device['name'])
-    if isinstance(queried_device, type(None)):
-        print(f"The device {device['name']} doesn't exist. Skipping.")
-        continue
-
-    manufacturer = {}
-    queried_manufacturer = nb_conn.dcim.manufacturers.get(name=device['manufacturer'].upper())
-    if isinstance(queried_manufacturer, type(None)):
-        print("Didn't find the manufacturer. Adding.")
-        added_manufacturer_dict = {'name': device['manufacturer'].upper(),
-                                   'slug': device['manufacturer'].lower()}
-        manufacturer = add_manufacturer(nb_conn, added_manufacturer_dict)
-    else:
-        print("Manufacturer found in Netbox.")
-        manufacturer = queried_manufacturer
-
-    device_type = []
-    queried_type = nb_conn.dcim.device_types.get(model=scraped_info['device_type'].upper())
-    if isinstance(queried_type, type(None)):
-        print("Didn't find that device type. Adding.")
-        device_type = {'model': scraped_info['device_type'].upper(),
-                       'slug': scraped_info['device_type'].lower(),
-                       'manufacturer': manufacturer.id}
-        device_type = add_device_type(nb_conn, device_type)
-    else:
-        print("Device type found in Netbox.")
-        device_type = queried_type
-
-    # Update the device
-    queried_device.device_type = device_type
-    queried_device.serial = scraped_info['serial']
-    if 'status' in device.keys():
-        queried_device.status = device['status']
-    queried_device.save()
-
-token.delete()
+        # Only send the fields that changed
+        change = {}
+        if 'model' in scraped_info:
+            device_type = resolver.device_type(scraped_info['model'], device.get('manufacturer'))
+            if device_type and queried_device.device_type.id != device_type.id:
+                change['device_type'] = device_type.id
+        if 'serial' in scraped_info and queried_device.serial != scraped_info['serial']:
+            change['serial'] = scraped_info['serial']
+        if 'status' in device.keys() and queried_device.status.value != device['status']:
+            change['status'] = device['status']
+        if change:
+            print(f"Updating {device['name']}.")
+            changes.append({'id': queried_device.id, **change})
+        else:
+            print(f"{device['name']} is up to date.")
+
+    bulk_update(nb_conn.dcim.devices, changes)
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,151 @@
 """
 Add sites to Netbox based on a YAML file
+
+Every site is pulled from Netbox at once and compared to `sites.yml` field by field. Only the fields
+that are different get sent, all in one bulk update. Run it with `plan` to see what would change
+without changing anything, or `apply` (the default) to make the changes.
 """
-import pynetbox
+import argparse
+import netbox_session
 import yaml
+from pynetbox.core.response import Record
+from netbox_bulk import bulk_update
+from yaml_loader import SITE_SCHEMA, load_yaml
 
 ENV_FILE = "env.yml"
 SITES_FILE = "sites.yml"
 
-with open(ENV_FILE) as file:
-    env_vars = yaml.safe_load(file)
-    
-with open(SITES_FILE) as file:
-    sites_to_load = yaml.safe_load(file)
-    
-nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-
-token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-
-for site in sites_to_load:
-    are_they_different = False
-    print(f"Checking {site['name']} for updates...", end="")
-    queried_site = nb_conn.dcim.sites.get(name=site['name'].upper())
-    if not queried_site:
-        print(f"Site {site['name']} does not exist. I'm choosing not to add it.")
-        continue
-    for key in site.keys():
-        if site[key] != queried_site[key]:
-            are_they_different = True
-    if are_they_different:
-        print("looks like it's different. Will update.")
-        queried_site.update(site)
-    else:
-        print("seems to be the same.")
-        continue
-    
-token.delete()
\ No newline at end of file
+
+def normalize(value):
+    """
+    Get a value from Netbox or the YAML file ready to be compared. Nested objects like a region or
+    status become the set of things they could be called in the YAML file (their value, slug,
+    name, or ID), and empty strings are treated like None.
+
+    Args:
+        value: The value to normalize
+
+    Returns:
+        The normalized value
+    """
+    if isinstance(value, Record):
+        value = dict(value)
+    if isinstance(value, dict):
+        return {value[key] for key in ("value", "slug", "name", "id") if value.get(key)}
+    if value == "":
+        return None
+    return value
+
+
+def values_match(desired, current) -> bool:
+    """
+    See if a value from the YAML file matches what Netbox has
+
+    Args:
+        desired: The value from the YAML file
+        current: The value from Netbox
+
+    Returns:
+        bool: Whether or not they're the same
+    """
+    desired, current = normalize(desired), normalize(current)
+    if isinstance(current, set):
+        # A nested value in the YAML file matches if any of its names do
+        if isinstance(desired, set):
+            return not desired.isdisjoint(current)
+        return desired in current
+    return desired == current
+
+
+def describe(value) -> str:
+    """
+    Show a Netbox value the way it would be written in the YAML file
+
+    Args:
+        value: The value from Netbox
+
+    Returns:
+        str: Something readable
+    """
+    if isinstance(value, (Record, dict)):
+        value = dict(value)
+        return str(value.get("value") or value.get("slug") or value.get("name") or value.get("id"))
+    return repr(value)
+
+
+def plan_site_changes(sites_to_load: list, netbox_sites: list) -> tuple:
+    """
+    Work out what has to change in Netbox to match the YAML file
+
+    Args:
+        sites_to_load (list): The sites from `SITES_FILE`
+        netbox_sites (list): All the sites in Netbox
+
+    Returns:
+        tuple: The list of changes (the site `id` and the fields to update), a dict of the
+          differences (field: (current, desired)) keyed by site name, and the names of the sites
+          that aren't in Netbox
+    """
+    sites_by_name = {site.name.upper(): site for site in netbox_sites}
+    changes = []
+    differences = {}
+    missing = []
+    for site in sites_to_load:
+        site_name = site['name'].upper()
+        queried_site = sites_by_name.get(site_name)
+        if not queried_site:
+            missing.append(site_name)
+            continue
+        desired = dict(site, name=site_name)
+        site_differences = {key: (queried_site[key], value) for key, value in desired.items()
+                            if not values_match(value, queried_site[key])}
+        if site_differences:
+            differences[site_name] = site_differences
+            changes.append({"id": queried_site.id,
+                            **{key: value for key, (_, value) in site_differences.items()}})
+    return changes, differences, missing
+
+
+def print_plan(sites_to_load: list, differences: dict, missing: list) -> None:
+    """
+    Show what's going to change
+
+    Args:
+        sites_to_load (list): The sites from `SITES_FILE`
+        differences (dict): The differences from plan_site_changes()
+        missing (list): The sites that aren't in Netbox
+    """
+    for site_name in missing:
+        print(f"Site {site_name} does not exist. I'm choosing not to add it.")
+    for site_name, site_differences in differences.items():
+        print(f"~ {site_name}")
+        for key, (current, desired) in site_differences.items():
+            print(f"    {key}: {describe(current)} -> {desired!r}")
+    unchanged = len(sites_to_load) - len(differences) - len(missing)
+    print(f"Plan: {len(differences)} to change, {unchanged} unchanged, {len(missing)} missing.")
+
+
+def main():
+    """
+    Run this
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("action", nargs="?", choices=["plan", "apply"], default="apply",
+                        help="plan just shows the changes, apply makes them (default: apply)")
+    args = parser.parse_args()
+
+    with open(ENV_FILE) as file:
+        env_vars = yaml.safe_load(file)
+
+    sites_to_load = load_yaml(SITES_FILE, SITE_SCHEMA)
+
+    nb_conn = netbox_session.connect(env_vars)
+
+    changes, differences, missing = plan_site_changes(sites_to_load, nb_conn.dcim.sites.all())
+    print_plan(sites_to_load, differences, missing)
+    if args.action == "apply" and changes:
+        updated = bulk_update(nb_conn.dcim.sites, changes)
+        print(f"Updated {sum(1 for site in updated if site)} of {len(changes)} sites.")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
 """
 Rebuild the data in Netbox based on various YAML files
 """
+import hashlib
+import json
+import os
+import netbox_session
 import pynetbox
 import yaml
 import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from netbox_bulk import bulk_create, chunked
+from yaml_loader import SITE_SCHEMA, SchemaError, load_yaml
 
 DEBUG_LEVEL = logging.DEBUG
 ENV_FILE = "env.yml"
@@ -12,7 +21,116 @@ DEV_ROLES_FILE = "device_roles.yml"
 DEVICES_FILE = "devices.yml"
 INTERFACES_FILE = "interfaces.yml"
 PREFIXES_FILE = "prefixes.yml"
+# How many objects to send to Netbox per POST
+BULK_CHUNK_SIZE = 200
+# How many stages can run at the same time
+MAX_STAGE_WORKERS = 4
+# How many sites to work on at the same time inside a stage
+MAX_SITE_WORKERS = 8
+# Where to remember what the last run loaded so unchanged stages can be skipped. Delete it to
+# force a full rebuild.
+REBUILD_STATE_FILE = ".rebuild_state.json"
+# Where to look for the Netbox changelog. It moved from extras to core in Netbox 4.1.
+CHANGELOG_APPS = ("core", "extras")
+# What every item in each YAML file has to have. They're checked before anything talks to Netbox.
+DEV_ROLE_SCHEMA = {"name": str}
+DEVICE_SCHEMA = {"name": str, "site": str, "type": str, "role": str}
+INTERFACES_SCHEMA = {"device": str, "interfaces": list}
+PREFIXES_SCHEMA = {"global": list, "sites": list}
+INPUT_SCHEMAS = {
+    SITES_FILE: SITE_SCHEMA,
+    DEV_ROLES_FILE: DEV_ROLE_SCHEMA,
+    DEVICES_FILE: DEVICE_SCHEMA,
+    INTERFACES_FILE: INTERFACES_SCHEMA,
+    PREFIXES_FILE: PREFIXES_SCHEMA,
+}
+
+
+class NetboxLookupCache:
+    """
+    Pulls reference data out of Netbox once and answers existence checks from memory.
+
+    Each object type is loaded with a single bulk `.all()` the first time it's asked for, then
+    indexed by the fields in `OBJECT_TYPES`. Anything created during the run should be handed to
+    `add()` so later lookups can see it without going back to Netbox. It's safe to share between
+    the stages running at the same time.
+    """
+    # object type: (app, endpoint, fields to index by)
+    OBJECT_TYPES = {
+        "sites": ("dcim", "sites", ("name", "slug")),
+        "device_roles": ("dcim", "device_roles", ("name", "slug")),
+        "manufacturers": ("dcim", "manufacturers", ("name", "slug")),
+        "device_types": ("dcim", "device_types", ("model", "slug")),
+        "devices": ("dcim", "devices", ("name",)),
+    }
 
+    def __init__(self, nb_conn):
+        self.nb_conn = nb_conn
+        self._indexes = {}
+        # One lock per object type so pulling every device doesn't hold up a lookup of a site
+        self._locks = {object_type: threading.Lock() for object_type in self.OBJECT_TYPES}
+
+    def _index_record(self, index: dict, record) -> None:
+        """
+        Put a record in an index under each of its indexed fields
+
+        Args:
+            index (dict): The index as {field: {value: record}}
+            record (pynetbox.Record): The object to add
+        """
+        for field, values in index.items():
+            value = getattr(record, field, None)
+            if value is not None:
+                values[value] = record
+
+    def _index_for(self, object_type: str) -> dict:
+        """
+        Get the index for an object type, loading it from Netbox if this is the first time. Only
+        lookups of the same object type wait while it loads.
+
+        Args:
+            object_type (str): One of the keys in `OBJECT_TYPES`
+
+        Returns:
+            dict: The index as {field: {value: record}}
+        """
+        index = self._indexes.get(object_type)
+        if index is not None:
+            return index
+        with self._locks[object_type]:
+            if object_type not in self._indexes:
+                app, endpoint, fields = self.OBJECT_TYPES[object_type]
+                index = {field: {} for field in fields}
+                for record in getattr(getattr(self.nb_conn, app), endpoint).all():
+                    self._index_record(index, record)
+                self._indexes[object_type] = index
+            return self._indexes[object_type]
+
+    def get(self, object_type: str, **kwargs):
+        """
+        Look up an object the same way you would with `endpoint.get(field=value)`
+
+        Args:
+            object_type (str): One of the keys in `OBJECT_TYPES`
+            **kwargs: Exactly one indexed field and the value to look for
+
+        Returns:
+            pynetbox.Record: The matching object or None if it doesn't exist
+        """
+        ((field, value),) = kwargs.items()
+        return self._index_for(object_type)[field].get(value)
+
+    def add(self, object_type: str, record) -> None:
+        """
+        Add a record to the cache, usually one that was just created
+
+        Args:
+            object_type (str): One of the keys in `OBJECT_TYPES`
+            record (pynetbox.Record): The object to add
+        """
+        index = self._index_for(object_type)
+        with self._locks[object_type]:
+            self._index_record(index, record)
 
 
 def setup_logging(log_level = logging.DEBUG):
@@ -24,59 +142,32 @@ def setup_logging(log_level = logging.DEBUG):
     ch.setFormatter(formatter)
     logger.addHandler(ch)
     return logger
-def load_env_from_yaml():
-    with open(ENV_FILE) as file:
-        return yaml.safe_load(file)
-
-def load_sites_from_yaml():
-    with open(SITES_FILE) as file:
-        return yaml.safe_load(file)
 
-def load_device_roles_from_yaml():
-    with open(DEV_ROLES_FILE) as file:
-        return yaml.safe_load(file)
 
+def load_input(input_file: str):
+    """
+    Load one of the YAML files and check it against its schema in `INPUT_SCHEMAS`. It comes from
+    the cache if the file hasn't changed.
 
-def load_devices_from_yaml():
-    with open(DEVICES_FILE) as file:
-        return yaml.safe_load(file)
+    Args:
+        input_file (str): The file to load
 
+    Returns:
+        The contents of the file
+    """
+    return load_yaml(input_file, INPUT_SCHEMAS.get(input_file))
 
-def load_interfaces_from_yaml():
-    with open(INTERFACES_FILE) as file:
-        return yaml.safe_load(file)
 
-def load_prefixes_from_yaml():
-    with open(PREFIXES_FILE) as file:
-        return yaml.safe_load(file)
-
-def main():
-    '''
-    The main stuff
-    :return: Nothing
-    '''
-    # Load the stuff from YAML
-    env_vars = load_env_from_yaml()
-    sites_to_load = load_sites_from_yaml()
-    # Connect to Netbox using the user and pass in the YAML
-    nb_conn = pynetbox.api(url=env_vars['netbox_url'])
-    token = nb_conn.create_token(env_vars['username'], env_vars['password'])
-    # Set up the logging
-    logger = setup_logging(log_level=DEBUG_LEVEL)
-    #####
-    #
-    #  Load the sites
-    #
-    #####
+def load_sites(nb_conn, nb_cache, logger):
+    """
+    Add the sites in `SITES_FILE` that aren't in Netbox yet
+    """
+    sites_to_load = load_input(SITES_FILE)
     for site in sites_to_load:
-        # Make sure the "name" key is given
-        if site.get('name') == None:
-            logger.error(f"Site does not have a name:\n{site}")
-            continue
         name = site['name'].upper()
         slug = site['name'].lower()
         # See if the site already exists
-        queried_site = nb_conn.dcim.sites.get(name=name)
+        queried_site = nb_cache.get("sites", name=name)
         if queried_site:
             logger.info(f"Site {site['name']} already exists.")
             continue
@@ -86,21 +177,18 @@ def main():
         if "physical_address" in site.keys():
             constructed_site['physical_address'] = site['physical_address']
         result = nb_conn.dcim.sites.create(constructed_site)
+        nb_cache.add("sites", result)
         logger.debug(f"Added site to Netbox: {result}")
 
 
-    #####
-    #
-    #  Load the device roles
-    #
-    #####
-    dev_roles_to_load = load_device_roles_from_yaml()
+def load_device_roles(nb_conn, nb_cache, logger):
+    """
+    Add the device roles in `DEV_ROLES_FILE` that aren't in Netbox yet
+    """
+    dev_roles_to_load = load_input(DEV_ROLES_FILE)
     for dev_role in dev_roles_to_load:
-        if dev_role.get('name') == None:
-            logger.error(f"Role doesn't have a name:\n{dev_role}")
-            continue
         dev_role_name = dev_role['name'].upper()
-        queried_dev_role = nb_conn.dcim.device_roles.get(name=dev_role_name)
+        queried_dev_role = nb_cache.get("device_roles", name=dev_role_name)
         if queried_dev_role:
             logger.info(f"Device role {dev_role['name']} already exists.")
             continue
@@ -108,14 +196,14 @@ def main():
         if "description" in dev_role.keys():
             constructed_dev_role['description'] = dev_role['description']
         result = nb_conn.dcim.device_roles.create(constructed_dev_role)
+        nb_cache.add("device_roles", result)
         logger.debug(f"Added device role to Netbox: {result}")
 
 
-    #####
-    #
-    #  Load a generic manufacturer and device type
-    #
-    #####
+def load_generic_device_type(nb_conn, nb_cache, logger):
+    """
+    Add a generic manufacturer and device type for the devices to use
+    """
     manufacturer = {
         "name": "GENERIC",
         "slug": "generic"
@@ -125,76 +213,70 @@ def main():
         "slug": "generic"
     }
 
-    queried_manufacturer = nb_conn.dcim.manufacturers.get(name=manufacturer['name'])
-    if queried_manufacturer:
+    man_result = nb_cache.get("manufacturers", name=manufacturer['name'])
+    if man_result:
         logger.info(f"Manufactuer {manufacturer['name']} already exits.")
     else:
         man_result = nb_conn.dcim.manufacturers.create(manufacturer)
+        nb_cache.add("manufacturers", man_result)
         logger.debug(f"Added manufacturer to Netbox: {man_result}")
 
 
-    queried_dev_type = nb_conn.dcim.device_types.get(slug=dev_type['slug'].lower())
+    queried_dev_type = nb_cache.get("device_types", slug=dev_type['slug'].lower())
     if queried_dev_type:
         logger.info(f"Device type {dev_type['slug'].upper()} already exists.")
     else:
         dev_type['manufacturer'] = man_result['id']
         type_result = nb_conn.dcim.device_types.create(dev_type)
+        nb_cache.add("device_types", type_result)
         logger.debug(f"Added device type to Netbox: {dev_type}")
 
-    #####
-    #
-    #  Load the devices
-    #
-    #####
-    required_keys = ['name', 'site', 'type', 'role']
 
+def load_devices(nb_conn, nb_cache, logger):
+    """
+    Add the devices in `DEVICES_FILE` that aren't in Netbox yet
+
+    Returns:
+        bool: False if any of them couldn't be added
+    """
     valid_devices_status = []
     for choice in nb_conn.dcim.devices.choices()['status']:
         valid_devices_status.append(choice['value'])
 
-    devices_to_load = load_devices_from_yaml()
+    devices_to_load = load_input(DEVICES_FILE)
+    devices_to_create = []
     for device in devices_to_load:
-        if device.get('name') == None:
-            logger.error(f"Device did not have a name:\n{device}")
-            continue
-
         name = device['name'].upper()
         slug = device['name'].lower()
 
         logger.debug(f"Processing {name}.")
 
         # See if the device already exists
-        queried_device = nb_conn.dcim.devices.get(name=name)
+        queried_device = nb_cache.get("devices", name=name)
         if queried_device:
             logger.info(f"The device {name} already exists. Skipping.")
             continue
+        if any(queued['name'] == name for queued in devices_to_create):
+            logger.info(f"The device {name} is already queued to be added. Skipping.")
+            continue
 
         # See if the given device type exists
-        if device.get('type') == None:
-            logger.error(f"Device did not have a type:\n{device}")
-            continue
         dev_type = device['type'].upper()
-        queried_type = nb_conn.dcim.device_types.get(slug=device['type'].lower())
+        queried_type = nb_cache.get("device_types", slug=device['type'].lower())
         if not queried_type:
             logger.info(f"The type {dev_type} does not exist. Skipping.\n{device}")
             continue
 
         # See if the given device role exists
-        if device.get('role') == None:
-            logger.error(f"Device did not have a role:\n{device}")
-            continue
         dev_role_name = device['role'].upper()
-        queried_dev_role = nb_conn.dcim.device_roles.get(name=dev_role_name)
+        queried_dev_role = nb_cache.get("device_roles", name=dev_role_name)
         if not queried_dev_role:
             logger.info(f"The role {dev_role_name} does not exist. Skipping.")
             continue
 
         # See if the given site exists
-        if device.get('site') == None:
-            logger.error(f"Device did not have a site:\n{device}")
-            continue
         site = device['site'].upper()
-        queried_site = nb_conn.dcim.sites.get(name=site)
+        queried_site = nb_cache.get("sites", name=site)
         # if isinstance(queried_site, type(None)):
         if not queried_site:
             logger.info(f"The site {site} does not exist. Skipping.")
@@ -211,60 +293,181 @@ def main():
                 logger.error(f"The status of {device['status']} isn't valid. Skipping.")
                 continue
         logger.debug(f"Adding {device['name']} to Netbox.")
-        result = nb_conn.dcim.devices.create(constructed_device)
-
-
-    #####
-    #
-    #  Load the interfaces
-    #
-    #####
-    interfaces_to_load = load_interfaces_from_yaml()
-
+        devices_to_create.append(constructed_device)
+
+    added_devices = bulk_create(nb_conn.dcim.devices, devices_to_create, chunk_size=BULK_CHUNK_SIZE,
+                                logger=logger)
+    for result in added_devices:
+        if result:
+            nb_cache.add("devices", result)
+    return None not in added_devices
+
+
+def load_interfaces(nb_conn, nb_cache, logger):
+    """
+    Add the interfaces in `INTERFACES_FILE` that aren't in Netbox yet, along with their addresses
+
+    Returns:
+        bool: False if any of them couldn't be added
+    """
+    interfaces_to_load = load_input(INTERFACES_FILE)
+    interfaces_to_create = []
+    # The addresses to put on the new interfaces, keyed by their spot in interfaces_to_create
+    addresses_for_interfaces = {}
+
+    # Get the interfaces for every device in the file with one query instead of one per interface
+    interface_devices = {}
     for device_info in interfaces_to_load:
         logger.debug(f"Querying Netbox for {device_info['device']}")
-        nb_queried_devices = nb_conn.dcim.devices.get(name=device_info['device'])
+        nb_queried_devices = nb_cache.get("devices", name=device_info['device'])
 
         if not nb_queried_devices:
             print(f"Skipping {device_info['device']} since it doesn't exist in NB.")
             continue
+        interface_devices[device_info['device']] = nb_queried_devices
 
-        # Get all the interfaces for this device in NB
-        logger.debug(f"Querying Netbox for interfaces on {nb_queried_devices.name}")
+    # The names of the interfaces already in NB, keyed by device ID
+    existing_interfaces = {device.id: set() for device in interface_devices.values()}
+    for device_ids in chunked(list(existing_interfaces), BULK_CHUNK_SIZE):
+        logger.debug(f"Querying Netbox for interfaces on {len(device_ids)} devices")
+        for intf in nb_conn.dcim.interfaces.filter(device_id=device_ids):
+            existing_interfaces[intf.device.id].add(intf.name)
 
+    for device_info in interfaces_to_load:
+        nb_queried_devices = interface_devices.get(device_info['device'])
+        if not nb_queried_devices:
+            continue
+        device_interfaces = existing_interfaces[nb_queried_devices.id]
 
         for device_intf in device_info['interfaces']:
-            nb_queried_interfaces = nb_conn.dcim.interfaces.filter(device_id=nb_queried_devices.id)
-            if_already_exists = False
             logger.debug(f"Processing {device_intf['name']} on {device_info['device']}")
-            for intf in nb_queried_interfaces:
-                logger.debug(f"Looking at interface {intf} on NB.")
-                if device_intf['name'] == intf.name:
-                    logger.debug(f"Interface {intf} already exists.")
-                    if_already_exists = True
-                    continue
-            if not if_already_exists:
-                logger.info(f"Adding interface {device_intf['name']}")
-                if device_intf.get('type') == None:
-                    intf_type = "virtual"
-                else:
-                    intf_type = device_intf['type']
-                added_interface = nb_conn.dcim.interfaces.create(name=device_intf['name'], device=nb_queried_devices.id, type=intf_type)
+            if device_intf['name'] in device_interfaces:
+                logger.debug(f"Interface {device_intf['name']} already exists. Skipping")
+                continue
+            logger.info(f"Adding interface {device_intf['name']}")
+            if device_intf.get('type') == None:
+                intf_type = "virtual"
             else:
-                logger.debug("Skipping")
-                added_interface = None
-
-            if device_intf.get('address') != None and added_interface != None:
-                added_address = nb_conn.ipam.ip_addresses.create(address=device_intf['address'], assigned_object_type="dcim.interface", assigned_object_id=added_interface.id,
-                                                                 description=f"{device_info['device']}:{added_interface.name}")
-
+                intf_type = device_intf['type']
+            if device_intf.get('address') != None:
+                addresses_for_interfaces[len(interfaces_to_create)] = (device_info['device'], device_intf['address'])
+            interfaces_to_create.append({"name": device_intf['name'], "device": nb_queried_devices.id, "type": intf_type})
+            device_interfaces.add(device_intf['name'])
+
+    added_interfaces = bulk_create(nb_conn.dcim.interfaces, interfaces_to_create, chunk_size=BULK_CHUNK_SIZE,
+                                   logger=logger)
+    addresses_to_create = []
+    for intf_index, (device_name, address) in addresses_for_interfaces.items():
+        added_interface = added_interfaces[intf_index]
+        if added_interface == None:
+            logger.error(f"Not adding {address} since its interface on {device_name} wasn't created.")
+            continue
+        addresses_to_create.append({"address": address, "assigned_object_type": "dcim.interface",
+                                    "assigned_object_id": added_interface.id,
+                                    "description": f"{device_name}:{added_interface.name}"})
+    added_addresses = bulk_create(nb_conn.ipam.ip_addresses, addresses_to_create,
+                                  chunk_size=BULK_CHUNK_SIZE, logger=logger)
+    return None not in added_interfaces and None not in added_addresses
+
+
+def plan_site_prefixes(nb_conn, nb_cache, logger, site):
+    """
+    Work out which container prefixes, VLANs, and VLAN prefixes a site in `PREFIXES_FILE` needs
+
+    Args:
+        site (dict): The site's entry from `PREFIXES_FILE`
+
+    Returns:
+        tuple: The prefixes to create, the VLANs to create, and the prefixes waiting on those
+          VLANs as (prefix, spot in the VLANs to create)
+    """
+    prefixes_to_create = []
+    vlans_to_create = []
+    prefixes_waiting_on_vlans = []
+    site_name = site['name'].upper()
+    queried_site = nb_cache.get("sites", name=site_name)
+    if not queried_site:
+        logger.error(f"Site {site['name']} does not exist. Skipping.")
+        return prefixes_to_create, vlans_to_create, prefixes_waiting_on_vlans
+    site_id = queried_site.id
+    logger.debug(f"Adding prefixes for site {site_name} with ID of {site_id}.")
+
+    # Index what the site already has once instead of asking Netbox again for every VLAN. Things
+    # are added as they're queued so a repeat in the YAML doesn't get queued twice.
+    existing_containers = {container.prefix for container in
+                           nb_conn.ipam.prefixes.filter(site_id=site_id, status="container")}
+    existing_prefixes = {queried_prefix.prefix for queried_prefix in
+                         nb_conn.ipam.prefixes.filter(site_id=site_id)}
+    existing_vlans = {(queried_vlan.vid, queried_vlan.name): queried_vlan for queried_vlan in
+                      nb_conn.ipam.vlans.filter(site_id=site_id)}
+    # The spot in vlans_to_create of each VLAN queued for this site, keyed by (vid, name)
+    queued_vlans = {}
+
+    for con_pre in site['container_prefixes']:
+        if con_pre['prefix'] in existing_containers:
+            logger.error(f"That container already exists.")
+            continue
+        con_pre_to_add = {
+            "status": "container",
+            "site": site_id,
+            "prefix": con_pre['prefix']
+        }
+        logger.info(f"Adding container prefix {con_pre['prefix']} to {site['name']}.")
+        prefixes_to_create.append(con_pre_to_add)
+        existing_containers.add(con_pre['prefix'])
+        existing_prefixes.add(con_pre['prefix'])
+
+    for vlan in site['vlans']:
+        vlan_key = (vlan['vid'], vlan['name'].upper())
+        working_vlan = existing_vlans.get(vlan_key)
+        if working_vlan:
+            logger.error(f"VLAN {vlan['vid']} in {site['name']} already exists. Not adding.")
+        elif vlan_key in queued_vlans:
+            logger.error(f"VLAN {vlan['vid']} in {site['name']} is already queued. Not adding.")
+        else:
+            vlan_to_add = {
+                "site": site_id,
+                "status": "active",
+                "name": vlan['name'].upper(),
+                "vid": vlan['vid']
+            }
+            logger.info(f"Adding VLAN {vlan['vid']} ({vlan['name']}) to {site['name']}.")
+            queued_vlans[vlan_key] = len(vlans_to_create)
+            vlans_to_create.append(vlan_to_add)
 
-    #####
-    #
-    #  Load the prefixes
-    #
-    #####
-    prefixes_to_load = load_prefixes_from_yaml()
+        if vlan['prefix'] in existing_prefixes:
+            logger.error(f"Prefix {vlan['prefix']} already exists. Not adding.")
+            continue
+        prefix_to_add = {
+            "status": "active",
+            "site": site_id,
+            "prefix": vlan['prefix'],
+            "description": vlan['name'].upper()
+        }
+        logger.info(f"Adding prefix {vlan['prefix']} to {site['name']}.")
+        existing_prefixes.add(vlan['prefix'])
+        if working_vlan:
+            prefix_to_add['vlan'] = working_vlan.id
+            prefixes_to_create.append(prefix_to_add)
+        else:
+            prefixes_waiting_on_vlans.append((prefix_to_add, queued_vlans[vlan_key]))
+    return prefixes_to_create, vlans_to_create, prefixes_waiting_on_vlans
+
+
+def load_prefixes(nb_conn, nb_cache, logger):
+    """
+    Add the global prefixes and the per-site containers, VLANs, and prefixes in `PREFIXES_FILE`
+    that aren't in Netbox yet. The sites are checked at the same time.
+
+    Returns:
+        bool: False if any of them couldn't be added
+    """
+    prefixes_to_load = load_input(PREFIXES_FILE)
+    prefixes_to_create = []
+    vlans_to_create = []
+    # VLAN prefixes that need the ID of a VLAN that hasn't been created yet, as
+    # (prefix, spot in vlans_to_create)
+    prefixes_waiting_on_vlans = []
     for global_container in prefixes_to_load['global']:
         # Track if the prefix already exists
         found_a_prefix = False
@@ -287,72 +490,287 @@ def main():
             "description": global_container['name'].upper(),
         }
         logger.debug(f"Adding prefix {global_container['prefix']} to {global_container['name']}.")
-        # Add the prefix
-        new_prefix = nb_conn.ipam.prefixes.create(prefix_to_add)
-
-    # Go through the list of `sites` in the YAML file
-    for site in prefixes_to_load['sites']:
-        site_name = site['name'].upper()
-        queried_site = nb_conn.dcim.sites.get(name=site_name)
-        if not queried_site:
-            logger.error(f"Site {site['name']} does not exist. Skipping.")
+        # Queue up the prefix
+        prefixes_to_create.append(prefix_to_add)
+
+    # Go through the list of `sites` in the YAML file, a few at a time
+    with ThreadPoolExecutor(max_workers=MAX_SITE_WORKERS) as pool:
+        site_plans = pool.map(lambda site: plan_site_prefixes(nb_conn, nb_cache, logger, site),
+                              prefixes_to_load['sites'])
+        for site_prefixes, site_vlans, site_waiting in site_plans:
+            prefixes_to_create.extend(site_prefixes)
+            prefixes_waiting_on_vlans.extend((prefix_to_add, len(vlans_to_create) + vlan_index)
+                                             for prefix_to_add, vlan_index in site_waiting)
+            vlans_to_create.extend(site_vlans)
+
+    # Create the VLANs, then the prefixes now that we know the VLAN IDs
+    added_vlans = bulk_create(nb_conn.ipam.vlans, vlans_to_create, chunk_size=BULK_CHUNK_SIZE, logger=logger)
+    for prefix_to_add, vlan_index in prefixes_waiting_on_vlans:
+        if added_vlans[vlan_index] == None:
+            logger.error(f"Not adding prefix {prefix_to_add['prefix']} since its VLAN wasn't created.")
             continue
-        site_id = queried_site.id
-        logger.debug(f"Adding prefixes for site {site_name} with ID of {site_id}.")
-
-        for con_pre in site['container_prefixes']:
-            queried_containers = nb_conn.ipam.prefixes.filter(site_id=site_id, status="container",
-                                                              prefix=con_pre['prefix'])
-            if len(queried_containers) > 0:
-                logger.error(f"That container already exists.")
-                continue
-            con_pre_to_add = {
-                "status": "container",
-                "site": site_id,
-                "prefix": con_pre['prefix']
-            }
-            new_con_pre = nb_conn.ipam.prefixes.create(con_pre_to_add)
-            logger.info(f"Added container prefix {new_con_pre['display']} as ID {new_con_pre['id']}.")
-
-        for vlan in site['vlans']:
-            queried_vlans = nb_conn.ipam.vlans.filter(site_id=site_id)
-            found_a_vlan = False
-            working_vlan = ""
-            for queried_vlan in queried_vlans:
-                if queried_vlan.vid == vlan['vid'] and queried_vlan.name == vlan['name'].upper():
-                    found_a_vlan = True
-                    working_vlan = queried_vlan
-            if found_a_vlan:
-                logger.error(f"VLAN {vlan['vid']} in {site['name']} already exists. Not adding.")
-            else:
-                vlan_to_add = {
-                    "site": site_id,
-                    "status": "active",
-                    "name": vlan['name'].upper(),
-                    "vid": vlan['vid']
-                }
-                logger.info(f"Adding VLAN {vlan['vid']} ({vlan['name']}) to {site['name']}.")
-                working_vlan = nb_conn.ipam.vlans.create(vlan_to_add)
-
-            queried_prefixes = nb_conn.ipam.prefixes.filter(site_id=site_id)
-            found_a_prefix = False
-            for queried_prefix in queried_prefixes:
-                if queried_prefix.prefix == vlan['prefix']:
-                    found_a_prefix = True
-            if found_a_prefix:
-                logger.error(f"Prefix {vlan['prefix']} already exists. Not adding.")
-                continue
-            prefix_to_add = {
-                "status": "active",
-                "site": site_id,
-                "vlan": working_vlan.id,
-                "prefix": vlan['prefix'],
-                "description": vlan['name'].upper()
-            }
-            logger.info(f"Adding prefix {vlan['prefix']} to {site['name']}.")
-            new_prefix = nb_conn.ipam.prefixes.create(prefix_to_add)
+        prefix_to_add['vlan'] = added_vlans[vlan_index].id
+        prefixes_to_create.append(prefix_to_add)
+    added_prefixes = bulk_create(nb_conn.ipam.prefixes, prefixes_to_create,
+                                 chunk_size=BULK_CHUNK_SIZE, logger=logger)
+    return None not in added_vlans and None not in added_prefixes
+
+
+Stage = namedtuple("Stage", ["run", "depends_on", "input_files"])
+
+# What gets loaded, what has to be in Netbox before it can be, and the YAML files it comes from.
+# Keep them in an order where each stage comes after the ones it depends on.
+STAGES = {
+    "sites": Stage(load_sites, (), (SITES_FILE,)),
+    "device_roles": Stage(load_device_roles, (), (DEV_ROLES_FILE,)),
+    "generic_device_type": Stage(load_generic_device_type, (), ()),
+    "devices": Stage(load_devices, ("sites", "device_roles", "generic_device_type"),
+                     (DEVICES_FILE,)),
+    "interfaces": Stage(load_interfaces, ("devices",), (INTERFACES_FILE,)),
+    "prefixes": Stage(load_prefixes, ("sites",), (PREFIXES_FILE,)),
+}
+
+
+def fingerprint_stages(stages: dict) -> dict:
+    """
+    Hash what goes into each stage: its YAML files and the fingerprints of the stages it depends
+    on. If anything upstream of a stage changes, so does its fingerprint.
+
+    Args:
+        stages (dict): The Stage for each stage name, in dependency order
+
+    Returns:
+        dict: The fingerprint for each stage name
+    """
+    fingerprints = {}
+    for name, stage in stages.items():
+        digest = hashlib.sha256(name.encode())
+        for input_file in stage.input_files:
+            with open(input_file, "rb") as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+        for dep in stage.depends_on:
+            digest.update(fingerprints[dep].encode())
+        fingerprints[name] = digest.hexdigest()
+    return fingerprints
+
+
+def _query_changelog(nb_conn, query):
+    """
+    Run a query against the Netbox changelog, wherever this Netbox keeps it
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        query (callable): Called with the object_changes endpoint
+
+    Returns:
+        Whatever `query` returned, or None if there's no changelog to ask
+    """
+    for app in CHANGELOG_APPS:
+        # Older versions of pynetbox don't have the core app
+        netbox_app = getattr(nb_conn, app, None)
+        if netbox_app is None:
+            continue
+        try:
+            return query(netbox_app.object_changes)
+        except pynetbox.RequestError:
+            continue
+    return None
+
+
+def latest_change_id(nb_conn) -> int:
+    """
+    Get the ID of the newest entry in the Netbox changelog. If it's the same as last time, nobody
+    has changed anything in Netbox since then.
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+
+    Returns:
+        int: The newest change's ID, or None if the changelog is empty
+    """
+    # Only pull the first page. The changelog is sorted newest first.
+    newest = _query_changelog(nb_conn, lambda changes: next(iter(changes.filter(limit=1)), None))
+    return newest.id if newest else None
+
+
+def only_changed_by(nb_conn, username: str, after_id: int, through_id: int) -> bool:
+    """
+    See if every change in a stretch of the Netbox changelog was made by one user
+
+    Args:
+        nb_conn (pynetbox.api): The Netbox connection
+        username (str): The user
+        after_id (int): Look at the changes after this ID. None means from the start.
+        through_id (int): Up to and including this ID
+
+    Returns:
+        bool: Whether nobody else changed anything
+    """
+    filters = {"id__gt": after_id or 0, "id__lte": through_id}
+    counts = _query_changelog(nb_conn, lambda changes: (
+        changes.count(**filters), changes.count(user_name=username, **filters)))
+    return counts is not None and counts[0] == counts[1]
+
+
+def load_rebuild_state(netbox_url: str) -> dict:
+    """
+    Get what the last run against this Netbox remembered
+
+    Args:
+        netbox_url (str): The Netbox URL
+
+    Returns:
+        dict: The 'change_id' and the 'stages' fingerprints, or an empty dict if there's nothing
+          saved for this Netbox
+    """
+    if not os.path.exists(REBUILD_STATE_FILE):
+        return {}
+    with open(REBUILD_STATE_FILE, encoding="UTF-8") as file:
+        state = json.load(file)
+    return state if state.get('netbox_url') == netbox_url else {}
+
+
+def save_rebuild_state(netbox_url: str, change_id: int, fingerprints: dict) -> None:
+    """
+    Remember what this run loaded for next time
+
+    Args:
+        netbox_url (str): The Netbox URL
+        change_id (int): The newest change in the Netbox changelog that this run has accounted for
+        fingerprints (dict): The fingerprints of the stages that finished
+    """
+    with open(REBUILD_STATE_FILE, "w", encoding="UTF-8") as file:
+        json.dump({"netbox_url": netbox_url, "change_id": change_id, "stages": fingerprints},
+                  file, indent=2)
+
+
+def check_inputs(stages: dict, logger) -> bool:
+    """
+    Load every stage's YAML files up front so bad data is caught before anything is added to
+    Netbox. The stages get what was loaded from the cache when they run.
+
+    Args:
+        stages (dict): The Stage for each stage name
+        logger: Where to report problems
+
+    Returns:
+        bool: False if any of the files can't be read or don't match their schemas
+    """
+    all_good = True
+    for input_file in sorted({input_file for stage in stages.values()
+                              for input_file in stage.input_files}):
+        try:
+            load_input(input_file)
+        except (SchemaError, yaml.YAMLError) as err:
+            logger.error(err)
+            all_good = False
+    return all_good
+
+
+def run_stages(stages: dict, nb_conn, nb_cache, logger,
+               max_workers: int = MAX_STAGE_WORKERS, unchanged: set = frozenset()) -> dict:
+    """
+    Run the stages at the same time as much as their dependencies allow. A stage starts as soon
+    as everything it depends on is done, and is skipped if any of them failed.
+
+    Args:
+        stages (dict): The Stage for each stage name, in dependency order
+        nb_conn (pynetbox.api): The Netbox connection
+        nb_cache (NetboxLookupCache): The shared lookup cache
+        logger (logging.Logger): Where to log
+        max_workers (int, optional): How many stages to run at once.
+          Defaults to MAX_STAGE_WORKERS.
+        unchanged (set, optional): Stages that don't need to run since nothing about them has
+          changed. They count as done for the stages that depend on them.
+
+    Returns:
+        dict: "done", "incomplete", "unchanged", "failed", or "skipped" for each stage name
+    """
+    results = {}
+    waiting = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while waiting or running:
+            for name, stage in list(waiting.items()):
+                failed_deps = [dep for dep in stage.depends_on
+                               if results.get(dep) in ("failed", "skipped")]
+                if failed_deps:
+                    logger.error(f"Skipping the {name} stage since {', '.join(failed_deps)} "
+                                 "didn't finish.")
+                    results[name] = "skipped"
+                    del waiting[name]
+                elif name in unchanged:
+                    logger.info(f"Nothing has changed for the {name} stage. Skipping.")
+                    results[name] = "unchanged"
+                    del waiting[name]
+                elif all(results.get(dep) in ("done", "unchanged", "incomplete")
+                         for dep in stage.depends_on):
+                    logger.debug(f"Starting the {name} stage.")
+                    running[pool.submit(stage.run, nb_conn, nb_cache, logger)] = name
+                    del waiting[name]
+            if not running:
+                logger.error(f"Can't work out what order to run {', '.join(waiting)} in.")
+                results.update((name, "skipped") for name in waiting)
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    if future.result() is False:
+                        # Run it again next time to pick up what didn't get added
+                        results[name] = "incomplete"
+                        logger.error(f"The {name} stage finished, but some things weren't added.")
+                    else:
+                        results[name] = "done"
+                        logger.debug(f"Finished the {name} stage.")
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception(f"The {name} stage failed.")
+                    results[name] = "failed"
+    return results
 
-    token.delete()
+
+def main():
+    '''
+    The main stuff
+    :return: Nothing
+    '''
+    # Set up the logging
+    logger = setup_logging(log_level=DEBUG_LEVEL)
+    # Load the stuff from YAML. The env file has the Netbox password in it, so don't cache it.
+    env_vars = load_yaml(ENV_FILE, use_cache=False)
+    if not check_inputs(STAGES, logger):
+        return
+    # Connect to Netbox using the user and pass in the YAML
+    nb_conn = netbox_session.connect(env_vars)
+    # Skip the stages whose YAML hasn't changed if nobody has touched Netbox since the last run
+    fingerprints = fingerprint_stages(STAGES)
+    state = load_rebuild_state(env_vars['netbox_url'])
+    change_id = latest_change_id(nb_conn)
+    unchanged = set()
+    if state and change_id is not None and state.get('change_id') == change_id:
+        unchanged = {name for name, fingerprint in fingerprints.items()
+                     if state['stages'].get(name) == fingerprint}
+    # A stage has to run again if anything it depends on is going to
+    for name, stage in STAGES.items():
+        if not unchanged.issuperset(stage.depends_on):
+            unchanged.discard(name)
+    if unchanged == set(STAGES):
+        logger.info("Nothing has changed since the last run.")
+        return
+    # Pull the reference data once instead of asking Netbox about every row
+    nb_cache = NetboxLookupCache(nb_conn)
+    results = run_stages(STAGES, nb_conn, nb_cache, logger, unchanged=unchanged)
+    # Only move past the changes this run made. If anyone else changed Netbox while it was running,
+    # keep the old ID so the next run checks everything again.
+    new_change_id = latest_change_id(nb_conn)
+    if new_change_id != change_id and \
+            not only_changed_by(nb_conn, env_vars['username'], change_id, new_change_id):
+        logger.info("Someone else changed Netbox during the run. Everything will run next time.")
+        new_change_id = change_id
+    # Only remember the stages that finished so the rest run again next time
+    save_rebuild_state(env_vars['netbox_url'], new_change_id,
+                       {name: fingerprints[name] for name, result in results.items()
+                        if result in ("done", "unchanged")})
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,97 @@
+"""
+Remembers what was last scraped from each device so the scripts don't have to log into it or look
+it up in Netbox again when nothing has changed
+
+The cache is a small sqlite database with the serial, model, and Netbox device ID of each device
+and when it was last scraped.
+"""
+import sqlite3
+import time
+from datetime import timedelta
+
+SCRAPE_CACHE_FILE = "scrape_cache.sqlite3"
+# Don't log into a device again if it was scraped less than this long ago
+SCRAPE_TTL = timedelta(days=7)
+
+
+class ScrapeCache:
+    """
+    The last scraped serial, model, and Netbox device ID for each device, keyed by device name
+
+    Changes are saved when the cache is closed, so use it as a context manager or call `close()`
+    when you're done.
+    """
+    def __init__(self, path: str = SCRAPE_CACHE_FILE, ttl: timedelta = SCRAPE_TTL):
+        self.ttl = ttl
+        self._db = sqlite3.connect(path)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("CREATE TABLE IF NOT EXISTS devices ("
+                         "name TEXT PRIMARY KEY, serial TEXT, model TEXT, netbox_id INTEGER, "
+                         "scraped_at REAL)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Save everything and close the database
+        """
+        self._db.commit()
+        self._db.close()
+
+    def get(self, name: str) -> dict:
+        """
+        Get what we know about a device
+
+        Args:
+            name (str): The device name
+
+        Returns:
+            dict: The device's 'serial', 'model', 'netbox_id', and 'scraped_at' (a Unix time), or
+              None if it's never been scraped
+        """
+        row = self._db.execute("SELECT * FROM devices WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def is_fresh(self, name: str) -> bool:
+        """
+        See if a device was scraped recently enough to skip it
+
+        Args:
+            name (str): The device name
+
+        Returns:
+            bool: Whether the device was scraped within the TTL
+        """
+        cached = self.get(name)
+        if not cached or cached['scraped_at'] is None:
+            return False
+        return time.time() - cached['scraped_at'] < self.ttl.total_seconds()
+
+    def record(self, name: str, **fields) -> None:
+        """
+        Save what was scraped from a device and mark it as scraped just now. Fields that aren't
+        given keep the values they had.
+
+        Args:
+            name (str): The device name
+            **fields: Any of 'serial', 'model', or 'netbox_id'
+        """
+        cached = self.get(name) or {'serial': None, 'model': None, 'netbox_id': None}
+        cached.update(fields)
+        self._db.execute("INSERT OR REPLACE INTO devices (name, serial, model, netbox_id, "
+                         "scraped_at) VALUES (?, ?, ?, ?, ?)",
+                         (name, cached['serial'], cached['model'], cached['netbox_id'],
+                          time.time()))
+
+    def forget(self, name: str) -> None:
+        """
+        Drop a device from the cache so it gets scraped and looked up again next time
+
+        Args:
+            name (str): The device name
+        """
+        self._db.execute("DELETE FROM devices WHERE name = ?", (name,))
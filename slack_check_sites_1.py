@@ -1,6 +1,7 @@
 import yaml
 import logging
-import requests
+import slack_notifier
+from yaml_loader import load_yaml
 
 SITES_FILE = "sites.yml"
 LOG_FILE = "check_sites.log"
@@ -10,59 +11,34 @@ CREDS_FILE = "device_creds.yml"
 SLACK_LEVEL = logging.DEBUG
 
 
-def send_to_slack(message: str, message_level: int):
-    """
-    Send a message to Slack
-
-    Args:
-        message (str): The message text
-        message_level (int): The message level (based on the Python logging module)
-
-    Returns:
-        bool: Whether or not the message was sent successfully
-    """
-    logging.debug(f"Posting to {creds['slack_url']}")
-    headers = {"text": message}
-    post_result = requests.post(url=creds['slack_url'], json=headers)
-    if post_result.status_code == 200:
-        return True
-    return False
-
-
 def log_the_message(message: str, message_level: int, local_logging: bool = True, slack: bool = True) -> None:
     """
     Log the message to the local logging handle and to Slack
 
+    Slack messages go through a queue and a background thread (see `slack_notifier`), so this
+    only waits on the local log file.
+
     Args:
         message (str): The message text
         message_level (int): The message level (based on the Python logging module)
         local_logging (bool, optional): Bool to log locally. Defaults to True.
         slack (bool, optional): Bool to log to Slack. Defaults to True.
     """
-    if local_logging:
-        if message_level == logging.CRITICAL:
-            logging.critical(message)
-        elif message_level == logging.ERROR:
-            logging.error(message)
-        elif message_level == logging.WARNING:
-            logging.warning(message)
-        elif message_level == logging.INFO:
-            logging.info(message)
-        elif message_level == logging.DEBUG:
-            logging.debug(message)
-    
-    if slack and message_level >= SLACK_LEVEL:
-        send_to_slack(message=message, message_level=logging.DEBUG)
+    logging.log(message_level, message, extra={"local_logging": local_logging, "slack": slack})
 
-logging.basicConfig(filename=LOG_FILE,
+local_handler = logging.FileHandler(LOG_FILE)
+local_handler.addFilter(lambda record: getattr(record, "local_logging", True))
+logging.basicConfig(handlers=[local_handler],
                     level=logging.DEBUG,
                     format=LOG_FORMAT)
 
 with open(CREDS_FILE, encoding='UTF-8') as file:
     creds = yaml.safe_load(file)
 
-with open(SITES_FILE, encoding='UTF-8') as file:
-    sites_to_load = yaml.safe_load(file)
+slack_notifier.setup_slack_logging(creds['slack_url'], level=SLACK_LEVEL)
+
+# No schema since finding the sites with missing fields is the point
+sites_to_load = load_yaml(SITES_FILE)
     
 for site in sites_to_load:
     if not "name" in site.keys():
@@ -0,0 +1,297 @@
+"""
+Sends messages to Slack from a background thread so the real work never waits on Slack.
+
+Messages are queued, merged into digests when they show up close together, and posted no faster
+than Slack's webhook rate limit allows. A 429 from Slack is honored with its Retry-After and
+server errors are retried with an exponential backoff. If Slack can't keep up and MAX_BACKLOG
+messages are waiting, new ones are dropped and counted, and the count goes out with the next
+digest.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import deque
+import requests
+
+# Slack cuts off messages around 4000 characters, so keep digests under that
+MAX_DIGEST_CHARS = 3500
+# How long to wait for more messages before sending a digest, in seconds
+FLUSH_INTERVAL = 2.0
+# Slack webhooks allow about one message per second
+MIN_SEND_INTERVAL = 1.0
+MAX_RETRIES = 5
+POST_TIMEOUT = 10
+# How many messages can wait on Slack before new ones start getting dropped
+MAX_BACKLOG = 1000
+NOTIFIER_THREAD_NAME = "slack-notifier"
+
+# Messages about the notifier itself shouldn't be sent to Slack
+logger = logging.getLogger(__name__)
+
+_FLUSH = object()
+_STOP = object()
+
+
+class SlackNotifier:
+    """
+    Queues messages for a Slack webhook and delivers them in order from a background thread
+
+    Use it as a context manager or call `close()` when you're done so nothing is left in the queue.
+    """
+    def __init__(self, slack_url: str, max_digest_chars: int = MAX_DIGEST_CHARS,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 min_send_interval: float = MIN_SEND_INTERVAL, max_retries: int = MAX_RETRIES,
+                 max_backlog: int = MAX_BACKLOG):
+        self.slack_url = slack_url
+        self.max_digest_chars = max_digest_chars
+        self.flush_interval = flush_interval
+        self.min_send_interval = min_send_interval
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        # Drops that haven't been reported to Slack yet, as [messages queued before them, count]
+        self._unreported_drops = deque()
+        self._queued = 0
+        self._delivered = 0
+        self._drops_lock = threading.Lock()
+        self._last_post = 0.0
+        self._queue = queue.Queue(maxsize=max_backlog)
+        self._session = requests.Session()
+        self._thread = threading.Thread(target=self._run, name=NOTIFIER_THREAD_NAME,
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send(self, message: str) -> None:
+        """
+        Queue a message to go to Slack. This returns right away. If the backlog is full, the
+        message is dropped and counted.
+
+        Args:
+            message (str): The message text
+        """
+        with self._drops_lock:
+            try:
+                self._queue.put_nowait(message)
+                self._queued += 1
+            except queue.Full:
+                self.dropped += 1
+                if self._unreported_drops and self._unreported_drops[-1][0] == self._queued:
+                    self._unreported_drops[-1][1] += 1
+                else:
+                    self._unreported_drops.append([self._queued, 1])
+
+    def flush(self) -> None:
+        """
+        Send whatever is queued right now and wait until it's been delivered
+        """
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Deliver everything still in the queue and stop the background thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._session.close()
+
+    def _run(self) -> None:
+        """
+        Pull messages off the queue and send them as digests until told to stop
+        """
+        digest = []
+        digest_chars = 0
+        deadline = None
+        while True:
+            timeout = None if not digest else max(0.0, deadline - time.monotonic())
+            try:
+                message = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # The time window closed, so send what we've got
+                self._deliver(digest)
+                digest, digest_chars = [], 0
+                continue
+
+            if message is _FLUSH or message is _STOP:
+                self._deliver(digest)
+                digest, digest_chars = [], 0
+                self._queue.task_done()
+                if message is _STOP:
+                    return
+                continue
+
+            # Send the current digest first if this message would make it too big
+            if digest and digest_chars + len(message) + 1 > self.max_digest_chars:
+                self._deliver(digest)
+                digest, digest_chars = [], 0
+            if not digest:
+                deadline = time.monotonic() + self.flush_interval
+            digest.append(message)
+            digest_chars += len(message) + 1
+            if digest_chars >= self.max_digest_chars:
+                self._deliver(digest)
+                digest, digest_chars = [], 0
+
+    def _deliver(self, digest: list) -> None:
+        """
+        Post a digest to Slack and mark its messages as done. Messages that were dropped after the
+        ones in the digest were queued are mentioned at the end, even if the digest is otherwise
+        empty.
+
+        Args:
+            digest (list): The messages to merge into one post
+        """
+        dropped = 0
+        with self._drops_lock:
+            self._delivered += len(digest)
+            while self._unreported_drops and self._unreported_drops[0][0] <= self._delivered:
+                dropped += self._unreported_drops.popleft()[1]
+        lines = list(digest)
+        if dropped:
+            lines.append(f"Dropped {dropped} messages because Slack couldn't keep up.")
+        if not lines:
+            return
+        if self._post("\n".join(lines)):
+            self.sent += len(digest)
+        else:
+            self.failed += len(digest)
+        for _ in digest:
+            self._queue.task_done()
+
+    def _post(self, text: str) -> bool:
+        """
+        Post to the webhook, staying under the rate limit and retrying when it makes sense
+
+        Args:
+            text (str): The message text
+
+        Returns:
+            bool: Whether or not the message was sent successfully
+        """
+        backoff = self.min_send_interval
+        for _ in range(self.max_retries + 1):
+            wait = self.min_send_interval - (time.monotonic() - self._last_post)
+            if wait > 0:
+                time.sleep(wait)
+            delay = backoff
+            try:
+                post_result = self._session.post(url=self.slack_url, json={"text": text},
+                                                 timeout=POST_TIMEOUT)
+            except requests.RequestException as err:
+                logger.warning(f"Couldn't reach Slack: {err}")
+            else:
+                if post_result.status_code == 200:
+                    self._last_post = time.monotonic()
+                    return True
+                if post_result.status_code == 429:
+                    delay = float(post_result.headers.get("Retry-After", backoff))
+                elif post_result.status_code < 500:
+                    # Retrying won't fix a bad request
+                    logger.error(f"Slack rejected a message with {post_result.status_code}: "
+                                 f"{post_result.text}")
+                    return False
+            self._last_post = time.monotonic()
+            time.sleep(delay)
+            backoff *= 2
+        logger.error(f"Gave up sending a message to Slack after {self.max_retries} retries.")
+        return False
+
+
+_notifiers = {}
+_notifiers_lock = threading.Lock()
+
+
+def get_notifier(slack_url: str) -> SlackNotifier:
+    """
+    Get the shared notifier for a webhook, starting it the first time. Shared notifiers are
+    flushed and stopped when the script exits.
+
+    Args:
+        slack_url (str): The URL to post to
+
+    Returns:
+        SlackNotifier: The notifier for that URL
+    """
+    with _notifiers_lock:
+        if slack_url not in _notifiers:
+            _notifiers[slack_url] = SlackNotifier(slack_url)
+        return _notifiers[slack_url]
+
+
+def send_to_slack(message: str, slack_url: str) -> None:
+    """
+    Queue a message for Slack on the shared notifier for `slack_url`
+
+    Args:
+        message (str): The message text
+        slack_url (str): The URL to post to
+    """
+    get_notifier(slack_url).send(message)
+
+
+class SlackLogHandler(logging.Handler):
+    """
+    Logging handler that hands records to a SlackNotifier. Set `slack=False` in a record's
+    `extra` to keep it off Slack.
+
+    The notifier sends from its own thread and drops messages instead of blocking when Slack
+    falls behind, so logging never waits on Slack.
+    """
+    def __init__(self, notifier: SlackNotifier, level: int = logging.NOTSET):
+        super().__init__(level)
+        self.notifier = notifier
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Anything logged while sending to Slack (like urllib3's connection messages) would
+        # just loop back around
+        if record.threadName == NOTIFIER_THREAD_NAME:
+            return False
+        return getattr(record, "slack", True) and super().filter(record)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.notifier.send(self.format(record))
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+def setup_slack_logging(slack_url: str, level: int = logging.WARNING,
+                        logger: logging.Logger = None) -> SlackLogHandler:
+    """
+    Send log records at or above `level` to Slack without making the logger wait on Slack
+
+    The records are batched through the shared notifier for `slack_url`, which is flushed when
+    the script exits.
+
+    Args:
+        slack_url (str): The URL to post to
+        level (int, optional): The lowest level to send to Slack. Defaults to logging.WARNING.
+        logger (logging.Logger, optional): The logger to attach to. Defaults to the root logger.
+
+    Returns:
+        SlackLogHandler: The handler that was added to the logger
+    """
+    handler = SlackLogHandler(get_notifier(slack_url), level=level)
+    (logger or logging.getLogger()).addHandler(handler)
+    return handler
+
+
+@atexit.register
+def _close_notifiers() -> None:
+    """
+    Make sure everything queued gets to Slack before the script exits
+    """
+    with _notifiers_lock:
+        for notifier in _notifiers.values():
+            notifier.close()
+        _notifiers.clear()
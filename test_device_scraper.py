@@ -0,0 +1,120 @@
+"""
+Checks that devices are scraped at the same time and that failed connections are retried the
+right way, using a fake Netmiko connection instead of real devices
+
+Run it with `python -m unittest test_device_scraper`.
+"""
+import threading
+import time
+import unittest
+from netmiko import NetmikoAuthenticationException, NetmikoTimeoutException
+from catalog_ip_addresses import collect_arp_tables
+from device_scraper import scrape_devices
+
+DEVICE_CREDS = {'username': 'admin', 'password': 'admin'}
+SUBNETS = [{'name': '192.168.0.0_24', 'subnet': '192.168.0.0/24'}]
+ARP_OUTPUT = (" #   ADDRESS         MAC-ADDRESS\n"
+              " 0 DC 192.168.0.10  AA:BB:CC:DD:EE:01\n"
+              " 1 DC 10.0.0.10     AA:BB:CC:DD:EE:02\n")
+
+
+class FakeConnection:
+    """
+    Stands in for a Netmiko ConnectHandler. Every command takes `delay` seconds.
+    """
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.disconnected = False
+
+    def send_command(self, command: str) -> str:
+        """
+        Pretend to run a command. Only the ARP table has any output.
+        """
+        time.sleep(self.delay)
+        if command.startswith("/ip/arp/print"):
+            return ARP_OUTPUT
+        return ""
+
+    def disconnect(self) -> None:
+        """
+        Pretend to log out
+        """
+        self.disconnected = True
+
+
+class FakeConnect:  # pylint: disable=too-few-public-methods
+    """
+    Stands in for connect_to_device(). Raises the errors in `failures` for an address, in order,
+    before connecting, and counts the attempts.
+    """
+    def __init__(self, delays: dict = None, failures: dict = None):
+        self.delays = delays or {}
+        self.failures = {address: list(errors) for address, errors in (failures or {}).items()}
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, address, username, password, **kwargs):
+        with self._lock:
+            self.attempts[address] = self.attempts.get(address, 0) + 1
+            errors = self.failures.get(address)
+            if errors:
+                raise errors.pop(0)
+        return FakeConnection(self.delays.get(address, 0.0))
+
+
+def make_devices(count: int) -> list:
+    """
+    Make some devices like the ones in `devices_to_update.yml`
+    """
+    return [{'name': f'RTR{number}', 'mgmt_ip': f'172.22.0.{number}'}
+            for number in range(1, count + 1)]
+
+
+class ScrapeDevicesTest(unittest.TestCase):
+    """
+    scrape_devices() and collect_arp_tables() with a fake connection
+    """
+    def test_devices_are_scraped_at_the_same_time(self):
+        """
+        Scraping a few slow devices takes about as long as the slowest one
+        """
+        devices = make_devices(4)
+        delays = {'172.22.0.1': 0.2, '172.22.0.2': 0.3, '172.22.0.3': 0.2, '172.22.0.4': 0.5}
+        start = time.monotonic()
+        arp_tables = collect_arp_tables(devices, DEVICE_CREDS, SUBNETS, max_workers=4,
+                                        connect=FakeConnect(delays))
+        elapsed = time.monotonic() - start
+        # About as long as the slowest device, not all of them added up
+        self.assertLess(elapsed, max(delays.values()) + 0.3)
+        self.assertEqual(set(arp_tables), {device['name'] for device in devices})
+        for entries in arp_tables.values():
+            self.assertEqual([entry.ip for entry in entries], ['192.168.0.10'])
+
+    def test_timeouts_are_retried(self):
+        """
+        A device that times out is tried again
+        """
+        connect = FakeConnect(failures={'172.22.0.1': [NetmikoTimeoutException("timed out")]})
+        results, errors = scrape_devices(make_devices(1), DEVICE_CREDS,
+                                         lambda connection, device: "scraped",
+                                         connect=connect, backoff=0)
+        self.assertEqual(results, {'RTR1': "scraped"})
+        self.assertEqual(errors, {})
+        self.assertEqual(connect.attempts['172.22.0.1'], 2)
+
+    def test_bad_passwords_are_not_retried(self):
+        """
+        A bad password fails the device right away without holding up the others
+        """
+        connect = FakeConnect(failures={
+            '172.22.0.1': [NetmikoAuthenticationException("bad password")]})
+        results, errors = scrape_devices(make_devices(2), DEVICE_CREDS,
+                                         lambda connection, device: "scraped",
+                                         connect=connect, backoff=0)
+        self.assertEqual(results, {'RTR2': "scraped"})
+        self.assertIsInstance(errors['RTR1'], NetmikoAuthenticationException)
+        self.assertEqual(connect.attempts['172.22.0.1'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
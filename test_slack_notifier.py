@@ -0,0 +1,182 @@
+"""
+Checks how SlackNotifier batches, orders, and retries messages against a local HTTP server that
+stands in for a Slack webhook
+
+Run it with `python -m unittest test_slack_notifier`.
+"""
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from slack_notifier import SlackNotifier
+
+# Keep the tests quick
+FLUSH_INTERVAL = 0.05
+MIN_SEND_INTERVAL = 0.01
+
+
+class FakeSlack:
+    """
+    A local webhook that records every post. It answers with the (status, headers) in
+    `responses`, in order, then 200 for everything after that.
+    """
+    def __init__(self, responses: list = None, delay: float = 0.0):
+        self.responses = list(responses or [])
+        self.delay = delay
+        # (status, text) for every post, in the order they came in
+        self.posts = []
+        self._lock = threading.Lock()
+        fake_slack = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Records the post and answers with the next response
+            """
+            def do_POST(self):  # pylint: disable=invalid-name
+                """
+                Handle a webhook post
+                """
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                time.sleep(fake_slack.delay)
+                status, headers = fake_slack.next_response()
+                fake_slack.record(status, body['text'])
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """
+                Keep the test output quiet
+                """
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def next_response(self) -> tuple:
+        """
+        Get the status and headers for the next post
+        """
+        with self._lock:
+            if self.responses:
+                return self.responses.pop(0)
+        return 200, {}
+
+    def record(self, status: int, text: str) -> None:
+        """
+        Remember a post and how it was answered
+        """
+        with self._lock:
+            self.posts.append((status, text))
+
+    def delivered(self) -> list:
+        """
+        Get the text of the posts that were accepted, in order
+        """
+        return [text for status, text in self.posts if status == 200]
+
+    def close(self) -> None:
+        """
+        Stop the server
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SlackNotifierTest(unittest.TestCase):
+    """
+    SlackNotifier against a fake Slack
+    """
+    def make_notifier(self, fake_slack: FakeSlack, **kwargs) -> SlackNotifier:
+        """
+        Make a notifier with quick timings for a fake Slack
+        """
+        kwargs.setdefault('flush_interval', FLUSH_INTERVAL)
+        kwargs.setdefault('min_send_interval', MIN_SEND_INTERVAL)
+        return SlackNotifier(fake_slack.url, **kwargs)
+
+    def setUp(self):
+        self.fake_slack = None
+
+    def tearDown(self):
+        if self.fake_slack:
+            self.fake_slack.close()
+
+    def test_messages_close_together_are_sent_as_one_digest(self):
+        """
+        A burst of messages goes out as one post with the messages in order
+        """
+        self.fake_slack = FakeSlack()
+        with self.make_notifier(self.fake_slack, flush_interval=0.5) as notifier:
+            for number in range(10):
+                notifier.send(f"message {number}")
+        self.assertEqual(self.fake_slack.delivered(),
+                         ["\n".join(f"message {number}" for number in range(10))])
+        self.assertEqual(notifier.sent, 10)
+
+    def test_big_digests_are_split_in_order(self):
+        """
+        Digests stay under the size limit and the messages stay in order across them
+        """
+        self.fake_slack = FakeSlack()
+        with self.make_notifier(self.fake_slack, max_digest_chars=40) as notifier:
+            for number in range(20):
+                notifier.send(f"message {number}")
+        delivered = self.fake_slack.delivered()
+        self.assertGreater(len(delivered), 1)
+        self.assertTrue(all(len(text) <= 40 for text in delivered))
+        self.assertEqual("\n".join(delivered).split("\n"),
+                         [f"message {number}" for number in range(20)])
+
+    def test_rate_limits_wait_for_retry_after(self):
+        """
+        A 429 is retried after the Retry-After time
+        """
+        self.fake_slack = FakeSlack(responses=[(429, {"Retry-After": "0.3"})])
+        start = time.monotonic()
+        with self.make_notifier(self.fake_slack) as notifier:
+            notifier.send("rate limited")
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual([status for status, _ in self.fake_slack.posts], [429, 200])
+        self.assertEqual(self.fake_slack.delivered(), ["rate limited"])
+        self.assertEqual(notifier.sent, 1)
+
+    def test_server_errors_are_retried(self):
+        """
+        5xx errors are retried until the post goes through
+        """
+        self.fake_slack = FakeSlack(responses=[(500, {}), (503, {})])
+        with self.make_notifier(self.fake_slack) as notifier:
+            notifier.send("flaky")
+        self.assertEqual([status for status, _ in self.fake_slack.posts], [500, 503, 200])
+        self.assertEqual(notifier.sent, 1)
+
+    def test_bad_requests_are_not_retried(self):
+        """
+        A 4xx other than 429 won't get better, so it's only tried once
+        """
+        self.fake_slack = FakeSlack(responses=[(400, {})])
+        with self.make_notifier(self.fake_slack) as notifier:
+            notifier.send("bad")
+        self.assertEqual(len(self.fake_slack.posts), 1)
+        self.assertEqual((notifier.sent, notifier.failed), (0, 1))
+
+    def test_dropped_messages_are_reported(self):
+        """
+        When Slack can't keep up, the extra messages are dropped and the count is still sent
+        """
+        self.fake_slack = FakeSlack(delay=0.05)
+        with self.make_notifier(self.fake_slack, max_backlog=5,
+                                max_digest_chars=10) as notifier:
+            for number in range(50):
+                notifier.send(f"log {number}")
+        self.assertGreater(notifier.dropped, 0)
+        self.assertEqual(notifier.sent + notifier.dropped, 50)
+        self.assertIn(f"Dropped {notifier.dropped} messages", self.fake_slack.delivered()[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
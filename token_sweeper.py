@@ -0,0 +1,266 @@
+"""
+Finds and deletes Netbox API tokens in bulk for the token cleanup scripts
+
+Netbox does the filtering (by user, last_used, etc.) so only the tokens to delete come over the
+wire, and they're deleted with bulk DELETEs spread over a few threads instead of one request per
+token. The token the script itself is using is never deleted.
+"""
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+import pynetbox
+import netbox_session
+from netbox_bulk import BULK_CHUNK_SIZE, bulk_delete
+
+# How many bulk DELETEs to have going at once
+MAX_WORKERS = 4
+# Where the buckets in the token age histogram start and stop
+AGE_BUCKETS = (timedelta(days=1), timedelta(days=7), timedelta(days=14), timedelta(days=30),
+               timedelta(days=90))
+HISTOGRAM_WIDTH = 40
+
+
+def find_tokens(nb_conn: pynetbox.api, **filters) -> list:
+    """
+    Get the tokens that match a set of Netbox filters, minus the one this connection is using
+
+    Args:
+        nb_conn (pynetbox.api): A connection from netbox_session.connect()
+        **filters: Netbox token filters like `user="admin"` or `last_used__lt="2024-01-01"`.
+          With no filters, every token is returned.
+
+    Returns:
+        list: The matching token records
+    """
+    my_token_id = netbox_session.session_token_id(nb_conn)
+    if filters:
+        tokens = nb_conn.users.tokens.filter(**filters)
+    else:
+        tokens = nb_conn.users.tokens.all()
+    return [token for token in tokens if token.id != my_token_id]
+
+
+def parse_last_used(token) -> datetime:
+    """
+    Get when a token was last used as a datetime with a timezone
+
+    Args:
+        token: A token record from Netbox
+
+    Returns:
+        datetime: When it was last used, or None if it never was or Netbox sent something
+          that isn't a timestamp. Timestamps without a timezone are taken to be UTC.
+    """
+    last_used = getattr(token, "last_used", None)
+    if not last_used:
+        return None
+    if isinstance(last_used, datetime):
+        parsed = last_used
+    else:
+        try:
+            # Older Pythons don't understand a trailing "Z"
+            parsed = datetime.fromisoformat(str(last_used).replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def find_stale_tokens(nb_conn: pynetbox.api, cutoff: datetime,
+                      logger: logging.Logger = None) -> list:
+    """
+    Get the tokens that were last used before a cutoff. Tokens that were never used aren't stale.
+
+    Netbox does the filtering, but it quietly ignores filters it doesn't know about and would
+    hand back every token, so each one is checked again here before it's handed over to be
+    deleted.
+
+    Args:
+        nb_conn (pynetbox.api): A connection from netbox_session.connect()
+        cutoff (datetime): Tokens last used before this are stale. It needs a timezone.
+        logger (logging.Logger, optional): Where to report tokens Netbox shouldn't have sent.
+          Defaults to the root logger.
+
+    Returns:
+        list: The stale token records
+    """
+    logger = logger or logging.getLogger()
+    stale_tokens = []
+    skipped = 0
+    for token in find_tokens(nb_conn, last_used__lt=cutoff.isoformat()):
+        last_used = parse_last_used(token)
+        if last_used is not None and last_used < cutoff:
+            stale_tokens.append(token)
+        else:
+            skipped += 1
+    if skipped:
+        logger.warning(f"Netbox returned {skipped} tokens that weren't last used before "
+                       f"{cutoff.isoformat()}. They won't be deleted.")
+    return stale_tokens
+
+
+def delete_tokens(nb_conn: pynetbox.api, tokens: list, dry_run: bool = False,
+                  max_workers: int = MAX_WORKERS, chunk_size: int = BULK_CHUNK_SIZE,
+                  logger: logging.Logger = None) -> dict:
+    """
+    Delete tokens in bulk and time how long it takes
+
+    Args:
+        nb_conn (pynetbox.api): A connection from netbox_session.connect()
+        tokens (list): The token records (or IDs) to delete
+        dry_run (bool, optional): Only report what would be deleted. Defaults to False.
+        max_workers (int, optional): How many bulk DELETEs to send at once.
+          Defaults to MAX_WORKERS.
+        chunk_size (int, optional): How many tokens to delete per request.
+          Defaults to BULK_CHUNK_SIZE.
+        logger (logging.Logger, optional): Where to report failures. Defaults to the root logger.
+
+    Returns:
+        dict: The 'found', 'deleted', and 'failed' counts, the 'seconds' the deletes took, and
+          whether it was a 'dry_run'
+    """
+    logger = logger or logging.getLogger()
+    my_token_id = netbox_session.session_token_id(nb_conn)
+    token_ids = [getattr(token, "id", token) for token in tokens]
+    token_ids = [token_id for token_id in token_ids if token_id != my_token_id]
+    for token_id in token_ids:
+        logger.debug(f"{'Would delete' if dry_run else 'Deleting'} token {token_id}")
+
+    start = time.monotonic()
+    if dry_run:
+        deleted = token_ids
+    else:
+        deleted = bulk_delete(nb_conn.users.tokens, token_ids, chunk_size=chunk_size,
+                              max_workers=max_workers, logger=logger)
+    return {
+        "found": len(token_ids),
+        "deleted": len(deleted),
+        "failed": len(token_ids) - len(deleted),
+        "seconds": time.monotonic() - start,
+        "dry_run": dry_run,
+    }
+
+
+def sweep_tokens(nb_conn: pynetbox.api, dry_run: bool = False, max_workers: int = MAX_WORKERS,
+                 chunk_size: int = BULK_CHUNK_SIZE, logger: logging.Logger = None,
+                 **filters) -> dict:
+    """
+    Find the tokens that match the filters and delete them
+
+    Args:
+        nb_conn (pynetbox.api): A connection from netbox_session.connect()
+        dry_run (bool, optional): Only report what would be deleted. Defaults to False.
+        max_workers (int, optional): How many bulk DELETEs to send at once.
+          Defaults to MAX_WORKERS.
+        chunk_size (int, optional): How many tokens to delete per request.
+          Defaults to BULK_CHUNK_SIZE.
+        logger (logging.Logger, optional): Where to report failures. Defaults to the root logger.
+        **filters: Netbox token filters passed on to find_tokens()
+
+    Returns:
+        dict: The report from delete_tokens()
+    """
+    return delete_tokens(nb_conn, find_tokens(nb_conn, **filters), dry_run=dry_run,
+                         max_workers=max_workers, chunk_size=chunk_size, logger=logger)
+
+
+def format_report(report: dict) -> str:
+    """
+    Turn a sweep report into a one-line summary
+
+    Args:
+        report (dict): The report from delete_tokens() or sweep_tokens()
+
+    Returns:
+        str: Something like "Deleted 20000 of 20000 tokens in 8.1s (2469 tokens/s)."
+    """
+    if not report['found']:
+        return "Found no tokens to delete."
+    if report['dry_run']:
+        return f"Dry run: would delete {report['found']} tokens."
+    rate = report['deleted'] / report['seconds'] if report['seconds'] else report['deleted']
+    summary = (f"Deleted {report['deleted']} of {report['found']} tokens in "
+               f"{report['seconds']:.1f}s ({rate:.0f} tokens/s).")
+    if report['failed']:
+        summary += f" {report['failed']} couldn't be deleted."
+    return summary
+
+
+def _format_age(age: timedelta) -> str:
+    """
+    Turn a bucket edge into something readable
+
+    Args:
+        age (timedelta): The bucket edge
+
+    Returns:
+        str: Something like "14d"
+    """
+    if age.days:
+        return f"{age.days}d"
+    return f"{int(age.total_seconds() // 3600)}h"
+
+
+def token_age_histogram(nb_conn: pynetbox.api, now: datetime,
+                        buckets: tuple = AGE_BUCKETS) -> list:
+    """
+    Count the tokens by how long ago they were last used
+
+    Netbox does the counting, so this is one small request per bucket no matter how many tokens
+    there are.
+
+    Args:
+        nb_conn (pynetbox.api): A connection from netbox_session.connect()
+        now (datetime): What time it is. It should have a timezone so Netbox doesn't have to guess.
+        buckets (tuple, optional): The bucket edges, from newest to oldest.
+          Defaults to AGE_BUCKETS.
+
+    Returns:
+        list: (label, count) for each bucket, ending with the tokens that were never used. It's
+          empty if Netbox can't filter tokens by when they were last used.
+    """
+    tokens = nb_conn.users.tokens
+    edges = [None, *buckets, None]
+    histogram = []
+    for newest, oldest in zip(edges, edges[1:]):
+        filters = {}
+        if newest is not None:
+            filters['last_used__lt'] = (now - newest).isoformat()
+        if oldest is not None:
+            filters['last_used__gte'] = (now - oldest).isoformat()
+        if newest is None:
+            label = f"< {_format_age(oldest)}"
+        elif oldest is None:
+            label = f">= {_format_age(newest)}"
+        else:
+            label = f"{_format_age(newest)} - {_format_age(oldest)}"
+        histogram.append((label, tokens.count(**filters)))
+    never_used = tokens.count() - sum(count for _, count in histogram)
+    # Netbox ignores filters it doesn't know about, so every bucket would count every token
+    if never_used < 0:
+        return []
+    histogram.append(("never used", never_used))
+    return histogram
+
+
+def format_age_histogram(histogram: list) -> str:
+    """
+    Draw a token age histogram as text
+
+    Args:
+        histogram (list): The (label, count) pairs from token_age_histogram()
+
+    Returns:
+        str: One line per bucket with its count and a bar
+    """
+    if not histogram:
+        return "Netbox can't filter tokens by when they were last used, so there's no histogram."
+    most = max((count for _, count in histogram), default=0) or 1
+    label_width = max(len(label) for label, _ in histogram)
+    count_width = len(str(most))
+    lines = ["Token ages (since last used):"]
+    for label, count in histogram:
+        bar = "#" * round(count / most * HISTOGRAM_WIDTH)
+        lines.append(f"  {label:<{label_width}}  {count:>{count_width}}  {bar}")
+    return "\n".join(lines)
@@ -0,0 +1,213 @@
+"""
+Loads the YAML inventory files quickly and makes sure they have what the scripts need
+
+libyaml's C parser is used when PyYAML was built with it. When a file is a list, each item is
+checked against a schema as soon as it's built, so the first bad item stops the load and bad data
+is caught before anything talks to Netbox. What was loaded is cached in CACHE_DIR and reused until
+the file changes.
+
+Don't cache files with secrets in them (like `env.yml` or `device_creds.yml`) since the cache
+isn't protected.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.events import DocumentStartEvent, SequenceEndEvent, SequenceStartEvent, StreamEndEvent
+from yaml.resolver import Resolver
+
+try:
+    from yaml.cyaml import CParser as Parser
+except ImportError:
+    from yaml.parser import Parser as _Parser
+    from yaml.reader import Reader
+    from yaml.scanner import Scanner
+
+    class Parser(Reader, Scanner, _Parser):
+        """
+        PyYAML's own parser, for when it was built without libyaml
+        """
+        def __init__(self, stream):
+            Reader.__init__(self, stream)
+            Scanner.__init__(self)
+            _Parser.__init__(self)
+
+CACHE_DIR = ".yaml_cache"
+# What the items in the files more than one script reads have to have. See compile_schema().
+SITE_SCHEMA = {"name": str}
+SUBNETS_SCHEMA = {"subnet": str}
+
+
+class _StreamLoader(Parser, Composer, SafeConstructor, Resolver):
+    """
+    A safe loader that can hand back one node at a time. It uses libyaml's parser when there is
+    one, with PyYAML's composer on top since the C loader only composes whole documents.
+    """
+    def __init__(self, stream):
+        Parser.__init__(self, stream)
+        Composer.__init__(self)
+        SafeConstructor.__init__(self)
+        Resolver.__init__(self)
+
+
+class SchemaError(ValueError):
+    """
+    Raised when a YAML file doesn't match its schema. The message lists every problem.
+    """
+
+
+def compile_schema(schema: dict):
+    """
+    Turn a schema into a function that checks an item against it
+
+    Args:
+        schema (dict): The keys every item has to have, each with the type (or tuple of types)
+          its value has to be
+
+    Returns:
+        callable: Takes an item and returns a list of what's wrong with it, which is empty if
+          it's fine
+    """
+    checks = tuple((key, types, " or ".join(kind.__name__ for kind in
+                                            (types if isinstance(types, tuple) else (types,))))
+                   for key, types in schema.items())
+
+    def validate(item) -> list:
+        if not isinstance(item, dict):
+            return ["isn't a mapping"]
+        problems = []
+        for key, types, type_names in checks:
+            if item.get(key) is None:
+                problems.append(f"is missing '{key}'")
+            elif not isinstance(item[key], types):
+                problems.append(f"has a '{key}' that isn't a {type_names}")
+        return problems
+    return validate
+
+
+def _start_document(loader) -> bool:
+    """
+    Move a loader past the start of the stream and the first document
+
+    Args:
+        loader (_StreamLoader): The loader
+
+    Returns:
+        bool: False if the file is empty
+    """
+    loader.get_event()
+    if not loader.check_event(DocumentStartEvent):
+        return False
+    loader.get_event()
+    return True
+
+
+def _end_document(loader, path: str) -> None:
+    """
+    Move a loader past the end of the document and make sure it was the only one
+
+    Args:
+        loader (_StreamLoader): The loader
+        path (str): The file being read, for error messages
+
+    Raises:
+        SchemaError: When there's another document after it
+    """
+    loader.get_event()
+    if not loader.check_event(StreamEndEvent):
+        raise SchemaError(f"{path} should only have one document.")
+
+
+def _read_items(loader, path: str, validate):
+    """
+    Build and check the items of a list one at a time. The loader has to be just past the start
+    of the list.
+
+    Args:
+        loader (_StreamLoader): The loader
+        path (str): The file being read, for error messages
+        validate (callable): From compile_schema(), or None to not check anything
+
+    Yields:
+        The next item in the list
+    """
+    index = 0
+    while not loader.check_event(SequenceEndEvent):
+        item = loader.construct_document(loader.compose_node(None, None))
+        if validate:
+            problems = validate(item)
+            if problems:
+                raise SchemaError(f"Item {index} in {path} {', and '.join(problems)}:\n{item}")
+        yield item
+        index += 1
+    loader.get_event()
+    _end_document(loader, path)
+
+
+def _cache_file(path: str) -> str:
+    """
+    Where the cached copy of a file goes
+
+    Args:
+        path (str): The YAML file
+
+    Returns:
+        str: The path of its cache file
+    """
+    name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{name}.pickle")
+
+
+def load_yaml(path: str, schema: dict = None, use_cache: bool = True):
+    """
+    Load a YAML file, using the cached copy if the file hasn't changed since it was cached
+
+    If the file is a list, each item is checked against `schema` as it's built. Otherwise the whole
+    document is checked.
+
+    Args:
+        path (str): The file to load
+        schema (dict, optional): What each item (or the document) has to look like. See
+          compile_schema().
+        use_cache (bool, optional): Whether to use and update the cache. Defaults to True.
+
+    Returns:
+        The contents of the file
+
+    Raises:
+        SchemaError: When the file doesn't match the schema
+    """
+    stat = os.stat(path)
+    file_key = (stat.st_mtime_ns, stat.st_size, repr(schema))
+    cache_file = _cache_file(path)
+    if use_cache and os.path.exists(cache_file):
+        with open(cache_file, "rb") as file:
+            cached = pickle.load(file)
+        if cached['key'] == file_key:
+            return cached['data']
+
+    validate = compile_schema(schema) if schema else None
+    data = None
+    with open(path, "rb") as file:
+        loader = _StreamLoader(file)
+        if _start_document(loader):
+            if loader.check_event(SequenceStartEvent):
+                loader.get_event()
+                data = list(_read_items(loader, path, validate))
+            else:
+                data = loader.construct_document(loader.compose_node(None, None))
+                problems = validate(data) if validate else []
+                if problems:
+                    raise SchemaError(f"{path} {', and '.join(problems)}.")
+                _end_document(loader, path)
+
+    if use_cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so another thread never reads half a cache file
+        descriptor, temp_file = tempfile.mkstemp(dir=CACHE_DIR)
+        with open(descriptor, "wb") as file:
+            pickle.dump({'key': file_key, 'data': data}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    return data